@@ -1,11 +1,18 @@
 
 from django.contrib import admin
 
-from .models import ADldap_Sync  # ,Employee
+from .models import ADldap_Sync, ADldap_SyncError  # ,Employee
 
 admin.site.register(ADldap_Sync)
 
 
+@admin.register(ADldap_SyncError)
+class ADldap_SyncErrorAdmin(admin.ModelAdmin):
+    list_display = ('dn', 'phase', 'name', 'attempts', 'last_failure')
+    list_filter = ('phase',)
+    search_fields = ('dn', 'name')
+
+
 ## Define an inline admin descriptor for Employee model
 ## which acts a bit like a singleton
 #class EmployeeInline(admin.StackedInline):
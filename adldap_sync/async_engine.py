@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSyncEngine(object):
+    """
+    asyncio driver for the syncldap command (syncldap --engine=async).
+
+    python-ldap is blocking, so the LDAP searches are offloaded to a thread pool
+    bounded by LDAP_SYNC_ASYNC_CONCURRENCY per server. Groups and users are
+    searched in parallel, the first chunks of users are read while the groups are
+    written, and the group memberships of a chunk of users are searched
+    concurrently while the previous chunk is written to the database.
+    All the database writes run in a single dedicated thread, in order.
+    """
+    QUEUE_SIZE = 2  # Chunks of users fetched ahead of the database writes
+
+    def __init__(self, command):
+        self.command = command
+        self.concurrency = command.conf_LDAP_SYNC_ASYNC_CONCURRENCY
+        self.semaphores = {}
+
+    def run(self):
+        """Run a whole synchronization. Returns the URIs of the groups and users LDAP servers."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        #Two extra workers, for the user stream and the initial group search
+        self.ldap_executor = ThreadPoolExecutor(max_workers=self.concurrency + 2)
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            return loop.run_until_complete(self.sync(loop))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            self.ldap_executor.shutdown()
+            #connection is looked up in the database thread, to close the connection of that thread
+            self.db_executor.submit(lambda: connection.close()).result()
+            self.db_executor.shutdown()
+
+    def get_semaphore(self, uri):
+        if (uri not in self.semaphores):
+            self.semaphores[uri] = asyncio.Semaphore(self.concurrency)
+        return self.semaphores[uri]
+
+    def ldap(self, loop, func, *args):
+        return loop.run_in_executor(self.ldap_executor, func, *args)
+
+    def db(self, loop, func, *args):
+        return loop.run_in_executor(self.db_executor, func, *args)
+
+    @staticmethod
+    def closing_connection(func):
+        """Close the Django connection opened by an LDAP thread (the sync records are read from the database)."""
+        def wrapper(*args):
+            try:
+                return func(*args)
+            finally:
+                connection.close()
+        return wrapper
+
+    async def sync(self, loop):
+        command = self.command
+        (uri_groups_server, ldap_groups), (uri_users_server, ldap_users) = await asyncio.gather(
+            self.ldap(loop, self.closing_connection(command.get_ldap_groups)),
+            self.ldap(loop, self.closing_connection(command.get_ldap_users)))
+        if ldap_users:
+            await self.sync_users(loop, uri_users_server, ldap_users, ldap_groups)
+        elif ldap_groups:
+            await self.db(loop, command.sync_ldap_groups, ldap_groups)
+        return (uri_groups_server, uri_users_server)
+
+    async def sync_users(self, loop, uri, ldap_users, ldap_groups=None):
+        """
+        Read the user stream one chunk at a time, prefetch the chunk memberships and
+        hand it over to sync_ldap_users, that runs in the database thread once the
+        groups are written. The first chunks are read while the groups are written.
+        """
+        command = self.command
+        chunks = queue.Queue(maxsize=self.QUEUE_SIZE)
+        command.membership_cache = {}
+        #The prefetch skips the users unchanged since the snapshot, so it's opened first
+        await self.db(loop, command.open_snapshot)
+
+        def sync_database():
+            if ldap_groups:
+                command.sync_ldap_groups(ldap_groups)
+            command.sync_ldap_users(self.iter_chunks(chunks))
+
+        db_future = self.db(loop, sync_database)
+        users = iter(ldap_users)
+        try:
+            while (not db_future.done()):
+                chunk = await self.ldap(loop, list, islice(users, command.conf_LDAP_SYNC_BULK_BATCH_SIZE))
+                #With the group graph, the memberships are resolved locally
+                if (command.conf_LDAP_SYNC_GROUP_MEMBERSHIP and (command.group_graph is None) and chunk):
+                    await self.prefetch_memberships(loop, uri, chunk)
+                await self.put(chunks, chunk, db_future)
+                if (not chunk):
+                    break
+        except Exception:
+            #Unblock the database thread before giving up
+            await self.put(chunks, [], db_future)
+            raise
+        try:
+            await db_future
+        finally:
+            command.membership_cache = None
+
+    async def put(self, chunks, chunk, db_future):
+        """Queue a chunk without blocking the event loop. Gives up if the database thread is gone."""
+        while (not db_future.done()):
+            try:
+                chunks.put_nowait(chunk)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    def iter_chunks(self, chunks):
+        """Entries queued by sync_users, until an empty chunk marks the end of the stream."""
+        dn_field = self.command.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD
+        while True:
+            chunk = chunks.get()
+            if (not chunk):
+                return
+            for entry in chunk:
+                yield entry
+            #The whole chunk is applied, so the memberships it didn't use are dropped
+            for entry in chunk:
+                self.command.membership_cache.pop(entry.value(dn_field), None)
+
+    async def prefetch_memberships(self, loop, uri, chunk):
+        command = self.command
+        semaphore = self.get_semaphore(uri)
+        dn_field = command.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD
+
+        async def prefetch(user_dn):
+            async with semaphore:
+                command.membership_cache[user_dn] = await self.ldap(loop, command.get_ldap_user_membership, user_dn)
+
+        #Only the membership of the users actually applied is needed
+        user_dns = set(entry.value(dn_field) for entry in chunk if command.is_applied_ldap_user(entry))
+        user_dns -= set(command.membership_cache)
+        user_dns.discard(None)
+        await asyncio.gather(*[prefetch(user_dn) for user_dn in user_dns])
+        logger.debug("Prefetched the group membership of %d users" % len(user_dns))
@@ -28,3 +28,24 @@ def removed_user_delete(user):
     source LDAP server.
     """
     user.delete()
+
+
+def removed_users_deactivate(users):
+    """
+    Batch version of removed_user_deactivate. Receives a queryset
+    of users and deactivates them with a single query.
+    """
+    users.filter(is_active=True).update(is_active=False)
+
+
+def removed_users_delete(users):
+    """
+    Batch version of removed_user_delete. Receives a queryset
+    of users and deletes them.
+    """
+    users.delete()
+
+
+#The sync command calls the batch version of a removed user callback when available
+removed_user_deactivate.batch = removed_users_deactivate
+removed_user_delete.batch = removed_users_delete
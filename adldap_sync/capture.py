@@ -0,0 +1,174 @@
+import base64
+import gzip
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+def encode_attributes(attributes):
+    return dict((name, [base64.b64encode(value).decode('ascii') for value in values]) for name, values in attributes)
+
+
+def decode_attributes(attributes):
+    return dict((name, [base64.b64decode(value) for value in values]) for name, values in attributes.items())
+
+
+class SearchCapture(object):
+    """
+    Writes the results of the LDAP searches to a gzipped JSON lines file, as they
+    are streamed, for ReplaySync. Each search starts with a line holding its
+    filter, then one line per entry with its DN and base64 values:
+    {"search": 1, "filter": "(objectClass=group)", "incremental": false}
+    {"search": 1, "dn": "CN=Staff,DC=example,DC=com", "attributes": {"cn": ["U3RhZmY="]}}
+    Searches may run concurrently (--engine=async), so their lines can be interleaved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.entries = 0
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def capture(self, search_filter, incremental, results):
+        """Record the results of a search. Streamed results are recorded as they are consumed."""
+        with self.lock:
+            self.searches += 1
+            search = self.searches
+        self.write({'search': search, 'filter': search_filter, 'incremental': incremental})
+        if (isinstance(results, list)):
+            for dn, attributes in results:
+                if (isinstance(attributes, dict)):
+                    self.entry(search, dn, attributes.items())
+            return results
+        return self.capture_entries(search, results)
+
+    def capture_entries(self, search, entries):
+        for entry in entries:
+            self.entry(search, entry.dn, entry.items())
+            yield entry
+
+    def entry(self, search, dn, attributes):
+        self.write({'search': search, 'dn': dn, 'attributes': encode_attributes(attributes)})
+        self.entries += 1
+
+    def close(self):
+        self.file.close()
+        logger.info("Captured %d LDAP searches (%d entries) to %s" % (self.searches, self.entries, self.path))
+
+
+class ReplaySync(object):
+    """
+    Runs a sync from a SearchCapture file instead of the LDAP servers, to measure
+    the database side of a sync without any network: the groups and users of the
+    capture are applied by the normal pipeline, and its throughput is reported.
+    Searches are matched by filter, so the config must be the one of the capture.
+    The users search is streamed from the file; the other searches are loaded first.
+    The incremental sync records aren't touched.
+    """
+
+    def __init__(self, command, path):
+        self.command = command
+        self.path = path
+        self.searches = defaultdict(deque)  # filter -> captured search ids, in order
+        self.incremental = {}  # search id -> if it was an incremental search
+        self.results = defaultdict(list)  # search id -> [(dn, encoded attributes)], except the streamed searches
+        self.counts = Counter()  # search id -> entries
+        self.queries = 0
+        self.db_time = 0
+
+    def read(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as capture:
+            for line in capture:
+                yield json.loads(line)
+
+    def load(self):
+        """First pass over the capture, keeping everything but the entries of the users search."""
+        users_filter = self.command.conf_LDAP_SYNC_USER_FILTER
+        streamed = set()
+        for record in self.read():
+            search = record['search']
+            if ('filter' in record):
+                self.searches[record['filter']].append(search)
+                self.incremental[search] = record['incremental']
+                if (record['filter'] == users_filter):
+                    streamed.add(search)
+                continue
+            self.counts[search] += 1
+            if (search not in streamed):
+                self.results[search].append((record['dn'], record['attributes']))
+        logger.info("Loaded %d captured LDAP searches from %s" % (len(self.incremental), self.path))
+
+    def stream(self, search):
+        """Entries of a streamed search, with a new pass over the capture."""
+        for record in self.read():
+            if ((record['search'] == search) and ('dn' in record)):
+                yield (record['dn'], record['attributes'])
+
+    def ldap_search(self, filter, attributes, incremental, incremental_filter, entry_type=None, search_info=None, shards=0):
+        """Replacement of Command.ldap_search(), serving the captured searches in order."""
+        uri = 'replay:%s' % self.path
+        searches = self.searches.get(filter)
+        if (not searches):
+            logger.warning("No captured search for the filter %s" % filter)
+            search, results = None, []
+        else:
+            search = (searches.popleft() if (len(searches) > 1) else searches[0])
+            results = (self.results[search] if (search in self.results) else self.stream(search))
+        if (search_info is not None):
+            search_info['incremental'] = self.incremental.get(search, False)
+            search_info['shard'] = None
+        if (entry_type is not None):
+            return (uri, (entry for entry in (entry_type.entry(dn, decode_attributes(values)) for dn, values in results) if entry is not None))
+        return (uri, [(dn, decode_attributes(values)) for dn, values in results])
+
+    def count_query(self, execute, sql, params, many, context):
+        started = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.time() - started
+
+    def run(self):
+        command = self.command
+        self.load()
+        command.ldap_search = self.ldap_search
+        #The users are counted by the capture
+        command.conf_LDAP_SYNC_PROGRESS_COUNT = False
+        report = {}
+        with connection.execute_wrapper(self.count_query):
+            started = time.time()
+            uri, ldap_groups = command.get_ldap_groups()
+            if ldap_groups:
+                command.sync_ldap_groups(ldap_groups)
+            report['groups'] = (command.stats_group_total, time.time() - started)
+
+            started = time.time()
+            uri, ldap_users = command.get_ldap_users()
+            users_searches = self.searches.get(command.conf_LDAP_SYNC_USER_FILTER)
+            if (users_searches):
+                command.users_estimate = self.counts[users_searches[0]]
+            if ldap_users:
+                command.sync_ldap_users(ldap_users)
+            report['users'] = (command.stats_user_total, time.time() - started)
+
+        for phase, (total, seconds) in report.items():
+            logger.info("Replayed %d %s in %.1fs: %.0f/s" % (total, phase, seconds, (total / seconds) if seconds else 0))
+        logger.info("Replay finished: %d database queries, %.1fs in the database. Users A:%d U:%d D:%d Err:%d. Memberships A:%d D:%d" %
+                    (self.queries, self.db_time, command.stats_user_added, command.stats_user_updated, command.stats_user_deleted,
+                     command.stats_user_errors, command.stats_membership_added, command.stats_membership_deleted))
+        report['queries'] = self.queries
+        report['db_time'] = self.db_time
+        return report
@@ -0,0 +1,45 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class SyncCheckpoint(object):
+    """
+    Progress of a full user sync, saved periodically to a JSON side file, so an
+    interrupted sync can be resumed (syncldap resume) instead of repeated. It
+    holds the usernames already applied, the last applied DN, the processed
+    entries count and the partial stats.
+    """
+
+    def __init__(self, path, fingerprint=''):
+        self.path = path
+        self.fingerprint = fingerprint
+
+    def load(self):
+        """The saved state, or None if there is none or it was saved with another config."""
+        if (not os.path.exists(self.path)):
+            return None
+        try:
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except ValueError as e:
+            logger.warning("Ignoring the invalid checkpoint %s: %s" % (self.path, e))
+            return None
+        if (state.get('fingerprint') != self.fingerprint):
+            logger.warning("Ignoring the checkpoint %s, it was saved with a different config" % self.path)
+            return None
+        return state
+
+    def save(self, state):
+        state = dict(state, fingerprint=self.fingerprint)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(tmp_path, self.path)
+        logger.debug("Checkpoint saved: %d entries processed, last DN %s" % (state['processed'], state['last_dn']))
+
+    def delete(self):
+        if (os.path.exists(self.path)):
+            os.remove(self.path)
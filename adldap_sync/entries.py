@@ -0,0 +1,78 @@
+class LDAPEntryType(object):
+    """
+    Fixed attribute layout shared by all the entries of one search. Entries store
+    their values in this order, so they don't need a dict of their own.
+    """
+
+    def __init__(self, attributes, binary_attributes=()):
+        self.attributes = tuple(attributes)
+        self.index = dict((name.lower(), position) for position, name in enumerate(self.attributes))
+        self.binary = set(position for position, name in enumerate(self.attributes) if name.lower() in binary_attributes)
+
+    def entry(self, dn, ldap_attributes):
+        """
+        Build an entry from a python-ldap result. Returns None for results without
+        attributes, like the search references returned by AD.
+        """
+        if (not isinstance(ldap_attributes, dict)):
+            return None
+        values = [None] * len(self.attributes)
+        for name, attribute in ldap_attributes.items():
+            position = self.index.get(name.lower())
+            if (position is not None):
+                values[position] = tuple(attribute)
+        return LDAPEntry(self, dn, values)
+
+
+class LDAPEntry(object):
+    """
+    Compact LDAP search result. Values are kept as the raw bytes returned by the
+    server and decoded on access. It behaves like the python-ldap attributes dict
+    ({name: [bytes, ...]}), so it can be passed to the user callbacks.
+    """
+    __slots__ = ('entry_type', 'dn', 'values')
+
+    def __init__(self, entry_type, dn, values):
+        self.entry_type = entry_type
+        self.dn = dn
+        self.values = values
+
+    def __getitem__(self, name):
+        position = self.entry_type.index.get(name.lower())
+        if ((position is None) or (self.values[position] is None)):
+            raise KeyError(name)
+        return list(self.values[position])
+
+    def __contains__(self, name):
+        position = self.entry_type.index.get(name.lower())
+        return ((position is not None) and (self.values[position] is not None))
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [name for name, value in zip(self.entry_type.attributes, self.values) if value is not None]
+
+    def items(self):
+        return [(name, list(value)) for name, value in zip(self.entry_type.attributes, self.values) if value is not None]
+
+    def value(self, name, default=None):
+        """First value of an attribute, decoded."""
+        values = self.get(name)
+        if (not values):
+            return default
+        return values[0].decode('utf-8')
+
+    def discard_binary(self):
+        """Drop the binary attributes (photos) once they are consumed."""
+        for position in self.entry_type.binary:
+            self.values[position] = None
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class GroupGraph(object):
+    """
+    Group nesting graph, built from the groups' memberOf attribute. It resolves the
+    transitive group membership of a user from its own memberOf, without the
+    LDAP_MATCHING_RULE_IN_CHAIN search per user. The graph can be cached in a
+    JSON file, so incremental syncs only update the edges of the changed groups
+    (see update_children) and drop the deleted ones (see prune).
+    """
+
+    def __init__(self, name_attribute):
+        self.name_attribute = name_attribute
+        self.groups = {}  # lowercased DN -> (DN, group name, lowercased parent DNs)
+        self.closures = {}
+
+    @classmethod
+    def load(cls, path, name_attribute):
+        """Read a cached graph. Returns None if there is none."""
+        if ((not path) or (not os.path.exists(path))):
+            return None
+        graph = cls(name_attribute)
+        try:
+            with open(path) as graph_file:
+                for key, (dn, name, parents) in json.load(graph_file)['groups'].items():
+                    graph.groups[key] = (dn, name, tuple(parents))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring the invalid group graph cache %s: %s" % (path, e))
+            return None
+        return graph
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as graph_file:
+            json.dump({'groups': self.groups}, graph_file)
+        os.replace(tmp_path, path)
+
+    def update(self, ldap_groups, memberof_attribute, full):
+        """
+        Add or replace the groups of an LDAP search. A full search replaces the
+        whole graph, an incremental one only the edges of the returned groups.
+        """
+        if full:
+            self.groups = {}
+        for dn, attributes in ldap_groups:
+            if ((dn is None) or (not isinstance(attributes, dict))):
+                continue
+            names = [values for name, values in attributes.items() if name.lower() == self.name_attribute.lower()]
+            if (not names):
+                continue
+            parents = []
+            for name, values in attributes.items():
+                if (name.lower() == memberof_attribute.lower()):
+                    parents = [value.decode('utf-8').lower() for value in values]
+            self.groups[dn.lower()] = (dn, names[0][0].decode('utf-8'), tuple(parents))
+        self.closures = {}
+        logger.debug("Group graph: %d groups" % len(self.groups))
+
+    def update_children(self, parent_dns, ldap_children, memberof_attribute):
+        """
+        Replace the child edges of some groups. memberOf is a backlink, so nesting a
+        group changes the parent (its member and whenChanged), not the child: the
+        groups nested in the changed ones must be searched again, by their memberOf.
+        """
+        parents = set(dn.lower() for dn in parent_dns)
+        for key, (dn, name, group_parents) in self.groups.items():
+            if (parents.intersection(group_parents)):
+                self.groups[key] = (dn, name, tuple(parent for parent in group_parents if parent not in parents))
+        self.update(ldap_children, memberof_attribute, False)
+
+    def prune(self, dns):
+        """Drop the groups that aren't in dns anymore, i.e. the ones deleted in LDAP."""
+        existing = set(dn.lower() for dn in dns)
+        deleted = set(self.groups) - existing
+        if (not deleted):
+            return
+        self.groups = dict((key, (dn, name, tuple(parent for parent in parents if parent not in deleted)))
+                           for key, (dn, name, parents) in self.groups.items() if key in existing)
+        self.closures = {}
+        logger.debug("Group graph: %d deleted groups dropped" % len(deleted))
+
+    def digest(self):
+        """Digest of the nesting edges. Groups that aren't nested in any other don't change it."""
+        graph_hash = hashlib.sha1()
+        for key in sorted(self.groups):
+            parents = self.groups[key][2]
+            if (parents):
+                graph_hash.update(repr((key, sorted(parents))).encode('utf-8'))
+        return graph_hash.hexdigest()
+
+    def closure(self, group_dn):
+        """Lowercased DNs of a group and all the groups it's nested in. Nesting cycles are allowed."""
+        if (group_dn in self.closures):
+            return self.closures[group_dn]
+        reachable = set()
+        pending = [group_dn]
+        while pending:
+            dn = pending.pop()
+            if ((dn in reachable) or (dn not in self.groups)):
+                continue
+            if ((dn != group_dn) and (dn in self.closures)):
+                #Already resolved, no need to walk it again
+                reachable.update(self.closures[dn])
+                continue
+            reachable.add(dn)
+            pending.extend(self.groups[dn][2])
+        self.closures[group_dn] = frozenset(reachable)
+        return self.closures[group_dn]
+
+    def get_user_groups(self, member_of):
+        """
+        Groups of a user from its memberOf values, shaped like the results of an
+        LDAP search: [(dn, {name_attribute: [name]}), ...]
+        """
+        group_dns = set()
+        for value in member_of:
+            group_dns.update(self.closure(value.decode('utf-8').lower()))
+        groups = []
+        for group_dn in group_dns:
+            dn, name, parents = self.groups[group_dn]
+            groups.append((dn, {self.name_attribute: [name.encode('utf-8')]}))
+        return groups
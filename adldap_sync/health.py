@@ -0,0 +1,74 @@
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class ServerHealth(object):
+    """
+    Health and round-trip time of the LDAP servers, cached in a Django cache.
+    Servers without a cached state are probed concurrently (connection and bind),
+    the ones too slow to answer are down, and the healthy ones are tried fastest first. Servers whose round-trip times
+    are within RTT_TOLERANCE keep their configured order, so runs don't flap
+    between equivalent DCs.
+    """
+    RTT_TOLERANCE = 0.01  # Seconds
+
+    def __init__(self, cache_alias='default', ttl=300):
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+
+    @staticmethod
+    def key(uri):
+        return 'adldap_sync.health.%s' % hashlib.md5(uri.encode('utf-8')).hexdigest()
+
+    def get(self, uri):
+        """Cached (healthy, rtt) of a server, or None."""
+        return self.cache.get(self.key(uri))
+
+    def set(self, uri, healthy, rtt=None):
+        self.cache.set(self.key(uri), (healthy, rtt), self.ttl)
+
+    def probe(self, uri, connect):
+        started = time.time()
+        try:
+            connect(uri)
+        except Exception as e:
+            logger.warning("LDAP server %s is down: %s" % (uri, e))
+            self.set(uri, False)
+            return (False, None)
+        rtt = time.time() - started
+        self.set(uri, True, rtt)
+        return (True, rtt)
+
+    def rank(self, uris, connect, timeout=None):
+        """
+        The URIs in the order to try them: healthy ones fastest first, then the ones
+        known to be down, as a last resort. connect(uri) must open and close a connection.
+        Probes that don't finish within timeout seconds are left running, and their server is down.
+        """
+        uris = list(dict.fromkeys(uris))
+        states = dict((uri, self.get(uri)) for uri in uris)
+        unknown = [uri for uri in uris if states[uri] is None]
+        if (unknown):
+            executor = ThreadPoolExecutor(max_workers=len(unknown))
+            probes = dict((uri, executor.submit(self.probe, uri, connect)) for uri in unknown)
+            wait(probes.values(), timeout)
+            #Not waiting for the hung probes, their threads end with their own timeout
+            executor.shutdown(wait=False)
+            for uri, probe in probes.items():
+                if (probe.done()):
+                    states[uri] = probe.result()
+                else:
+                    logger.warning("LDAP server %s is down: no answer in %ss" % (uri, timeout))
+                    self.set(uri, False)
+                    states[uri] = (False, None)
+        healthy = [uri for uri in uris if states[uri][0]]
+        healthy.sort(key=lambda uri: (int(states[uri][1] / self.RTT_TOLERANCE), uris.index(uri)))
+        down = [uri for uri in uris if (not states[uri][0])]
+        logger.debug("LDAP servers by round-trip time: %s" % ", ".join("%s (%.0fms)" % (uri, states[uri][1] * 1000) for uri in healthy))
+        return (healthy + down)
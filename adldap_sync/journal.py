@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
+from django.db import transaction
+
+from adldap_sync.models import ADldap_SyncError
+from adldap_sync.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorJournal(object):
+    """
+    Journal of the LDAP entries that failed to sync, kept in ADldap_SyncError.
+    Errors are collected during a phase and written by save(), which also clears
+    the entries applied without errors since. Only the entries already in the
+    journal are tracked, so a full sync doesn't keep every DN in memory.
+    """
+    USER_PHASES = ('user', 'profile', 'photo', 'membership')
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()  # Memberships may be searched from other threads
+        self.journaled = None  # DNs in the journal, loaded on first use
+        self.errors = {}  # (dn, phase) -> (name, message)
+        self.applied = set()  # (dn, entry type) of the journaled DNs seen in this run
+
+    def error(self, phase, dn, name, error):
+        if (dn is None):
+            return
+        with self.lock:
+            self.errors[(dn, phase)] = (name or '', str(error))
+
+    def seen(self, entry_type, dn):
+        """An entry of the journal was applied again. Its errors of this run, if any, are still saved."""
+        if (self.journaled is None):
+            self.journaled = set(ADldap_SyncError.objects.values_list('dn', flat=True))
+        if (dn in self.journaled):
+            self.applied.add((dn, entry_type))
+
+    def save(self):
+        with self.lock:
+            errors, self.errors = self.errors, {}
+            applied, self.applied = self.applied, set()
+        failed_phases = defaultdict(set)  # dn -> phases that failed again
+        for dn, phase in errors:
+            failed_phases[dn].add(phase)
+        for entry_type in ('group', 'user'):
+            phases = (('group',) if (entry_type == 'group') else self.USER_PHASES)
+            dns = [dn for dn, applied_type in applied if (applied_type == entry_type)]
+            for chunk in chunked([dn for dn in dns if dn not in failed_phases], self.batch_size):
+                ADldap_SyncError.objects.filter(dn__in=chunk, phase__in=phases).delete()
+            #The phases that failed again keep their row, and count one more attempt
+            for dn in dns:
+                if (dn in failed_phases):
+                    ADldap_SyncError.objects.filter(dn=dn, phase__in=phases).exclude(phase__in=failed_phases[dn]).delete()
+            if (self.journaled is not None):
+                self.journaled.difference_update(dns)
+        if (not errors):
+            return
+
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        existing = {}
+        for chunk in chunked(set(dn for dn, phase in errors), self.batch_size):
+            for journaled in ADldap_SyncError.objects.filter(dn__in=chunk):
+                existing[(journaled.dn, journaled.phase)] = journaled
+        updated, created = [], []
+        for (dn, phase), (name, message) in errors.items():
+            journaled = existing.get((dn, phase))
+            if (journaled is None):
+                created.append(ADldap_SyncError(dn=dn, phase=phase, name=name[:250], error=message, first_failure=now, last_failure=now))
+            else:
+                journaled.name, journaled.error, journaled.last_failure = name[:250], message, now
+                journaled.attempts += 1
+                updated.append(journaled)
+        with transaction.atomic():
+            ADldap_SyncError.objects.bulk_create(created, batch_size=self.batch_size)
+            ADldap_SyncError.objects.bulk_update(updated, ['name', 'error', 'attempts', 'last_failure'], batch_size=self.batch_size)
+        if (self.journaled is not None):
+            self.journaled.update(dn for dn, phase in errors)
+        logger.info("Error journal: %d entries failed, %d of them already did" % (len(errors), len(updated)))
@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class SyncLock(object):
+    """
+    Lock held while a sync runs, so scheduled runs never overlap. It lives in a
+    Django cache shared by all the workers (cache.add() is atomic on memcached,
+    redis and the database cache). A heartbeat thread keeps it alive; if the
+    holder dies, the lock expires after timeout seconds and is taken over.
+    """
+    POLL_INTERVAL = 1
+
+    def __init__(self, key, cache_alias='default', timeout=300):
+        self.key = key
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    @property
+    def cache(self):
+        #Cache connections are per thread
+        return caches[self.cache_alias]
+
+    def acquire(self, wait=0):
+        """
+        Take the lock, waiting at most wait seconds for the running sync.
+        Returns whether it was acquired.
+        """
+        deadline = time.time() + wait
+        while (not self.cache.add(self.key, self.token, self.timeout)):
+            if (time.time() >= deadline):
+                return False
+            time.sleep(self.POLL_INTERVAL)
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self.beat, name='adldap_sync lock heartbeat')
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+        return True
+
+    def beat(self):
+        while (not self.stopped.wait(self.timeout / 3.0)):
+            if (self.cache.get(self.key) != self.token):
+                logger.error("Sync lock %s lost: another sync may be running" % self.key)
+                return
+            self.cache.set(self.key, self.token, self.timeout)
+
+    def release(self):
+        self.stopped.set()
+        if (self.heartbeat is not None):
+            self.heartbeat.join()
+            self.heartbeat = None
+        if (self.cache.get(self.key) == self.token):
+            self.cache.delete(self.key)
@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
+import copy
 import logging
+import threading
+import time
 import uuid
 import pytz
 from datetime import datetime, timedelta
@@ -10,15 +13,34 @@ from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import ContentFile
 from django.core.management.base import BaseCommand
-from django.db import DataError, IntegrityError
+from django.core.signals import setting_changed
+from django.db import DataError, IntegrityError, transaction
+from django.db.models.functions import Lower
+from django.dispatch import receiver
 from django.utils.module_loading import import_string
 from ldap.controls import SimplePagedResultsControl
 from ldap.ldapobject import LDAPObject
 
-from adldap_sync.models import ADldap_Sync
+from adldap_sync.async_engine import AsyncSyncEngine
+from adldap_sync.capture import ReplaySync, SearchCapture
+from adldap_sync.checkpoint import SyncCheckpoint
+from adldap_sync.entries import LDAPEntryType
+from adldap_sync.graph import GroupGraph
+from adldap_sync.health import ServerHealth
+from adldap_sync.journal import ErrorJournal
+from adldap_sync.lock import SyncLock
+from adldap_sync.models import ADldap_Sync, ADldap_SyncError
+from adldap_sync.paging import PageSizeTuner
+from adldap_sync.photos import PhotoUploader
+from adldap_sync.progress import SyncProgress
+from adldap_sync.query import LDAPQueryBuilder
+from adldap_sync.resolver import DNResolver
+from adldap_sync.snapshot import LDAPSnapshot
+from adldap_sync.sources import MultiSourceSync
+from adldap_sync.utils import DecodeCache, chunked
 
 logger = logging.getLogger(__name__)
 
@@ -27,14 +49,31 @@ class Command(BaseCommand):
     can_import_settings = True
     help = 'Synchronize users and groups from an authoritative LDAP server'
     ATTRIBUTE_DISABLED = 'userAccountControl'
+    ATTRIBUTE_GUID = 'objectGUID'
+    ATTRIBUTE_MEMBEROF = 'memberOf'
+    ATTRIBUTE_NO_ATTRIBUTES = '1.1'  # RFC 4511: return no attributes, only the DNs
     FLAG_UF_ACCOUNT_DISABLE = 2
+    PHOTO_ATTRIBUTES = ('thumbnailphoto', 'jpegphoto', 'thumbnaillogo')
+    REMOVAL_ACTIONS = ('DEACTIVATE', 'DELETE', 'KEEP')
+    LOCK_KEY = 'adldap_sync.lock'
+    #Settings each of the LDAP_SYNC_SOURCES can override, without the LDAP_SYNC_ prefix
+    SOURCE_SETTINGS = ('BIND_URI', 'BIND_DN', 'BIND_PASS', 'BIND_SEARCH', 'USER_SEARCH', 'USER_FILTER', 'USER_FILTER_INCREMENTAL', 'USER_INCREMENTAL',
+                       'GROUP_SEARCH', 'GROUP_FILTER', 'GROUP_FILTER_INCREMENTAL', 'GROUP_INCREMENTAL', 'GROUP_MEMBERSHIP_FILTER', 'GROUP_GRAPH_FILE')
+    CHECKPOINT_STATS = ('stats_user_added', 'stats_user_updated', 'stats_user_deleted', 'stats_user_errors', 'stats_user_unchanged',
+                        'stats_membership_total', 'stats_membership_added', 'stats_membership_deleted', 'stats_membership_errors')
     ### CONFIG VARIABLES. Default Values
     #AD/LDAP CONNECTION VARS
     conf_LDAP_SYNC_BIND_URI = []  # A string or an array for failover, i.e.  ["ldap://dc1.example.com:389","ldap://dc2.example.com:389",]
     conf_LDAP_SYNC_BIND_DN = ''  # AD User to search. DON'T USE AN ADMIN ACCOUNT!!!!!
     conf_LDAP_SYNC_BIND_PASS = ''  # The ldap user password
     conf_LDAP_SYNC_BIND_SEARCH = ''  # I.e. "OU=Department,DC=example,DC=com"
-    #conf_LDAP_SYNC_BIND_PAGESIZE = 200 #Used on PagedResultsSearchObject class below
+    conf_LDAP_SYNC_BIND_PAGESIZE = 200  # Page size of the searches, or the first one with LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE
+    conf_LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE = True  # Tune the page size on each search, and keep the learned one for each URI
+    conf_LDAP_SYNC_BIND_MAXPAGESIZE = 1000  # MaxPageSize of the AD query policy
+    conf_LDAP_SYNC_BIND_PAGE_MAXBYTES = 8 * 1024 * 1024  # The page size shrinks if pages are bigger than this (photos)
+    conf_LDAP_SYNC_BIND_TIMEOUT = 5  # Seconds to connect to an LDAP server, and to bind, before failing over
+    conf_LDAP_SYNC_BIND_HEALTH_CACHE = 'default'  # Django cache keeping the health and round-trip time of each server. Empty to try them in order
+    conf_LDAP_SYNC_BIND_HEALTH_TTL = 300  # Seconds a server health is cached
 
     #USERS
     conf_LDAP_SYNC_USER = True
@@ -42,6 +81,7 @@ class Command(BaseCommand):
     conf_LDAP_SYNC_USER_SEARCH = ''  # I.e. "OU=Department,DC=example,DC=com"
     conf_LDAP_SYNC_USER_FILTER = '(&(objectCategory=person)(objectClass=user))'
     conf_LDAP_SYNC_USER_FILTER_INCREMENTAL = '(&(objectCategory=person)(objectClass=user)(whenchanged>=?))'
+    conf_LDAP_SYNC_USER_SHARDS = 0  # Rolling full sync: each incremental run also syncs 1/N of the users, by username range. 0 to disable
     conf_LDAP_SYNC_USER_ATTRIBUTES = {"sAMAccountName": "username", "givenName": "first_name", "sn": "last_name", "mail": "email", }
     conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES = [ATTRIBUTE_DISABLED] 
     #['userAccountControl','company','department','distinguishedName','division','extensionName','manager','mobile','physicalDeliveryOfficename','title','thumbnailPhoto']
@@ -49,13 +89,22 @@ class Command(BaseCommand):
     conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC = ['admin', 'administrator', 'administrador', 'guest']
     conf_LDAP_SYNC_USER_CALLBACKS = []
     conf_LDAP_SYNC_USER_SET_UNUSABLE_PASSWORD = True
-    conf_LDAP_SYNC_USER_REMOVAL_ACTION = 'DEACTIVATE'
+    conf_LDAP_SYNC_USER_REMOVAL_ACTION = 'DEACTIVATE'  # DEACTIVATE, DELETE or KEEP Django users missing on a full LDAP sync
+    conf_LDAP_SYNC_USER_REMOVAL_THRESHOLD = 0.1  # Abort the removal if more than this fraction of Django users would be removed
     conf_LDAP_SYNC_USER_SHOW_PROGRESS = True
+    conf_LDAP_SYNC_PROGRESS_CACHE = 'default'  # Django cache where the progress of the running sync is published. Empty to disable
+    conf_LDAP_SYNC_PROGRESS_COUNT = False  # Count the users with a search without attributes, instead of using the previous full sync total
     conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME = "{username}_{uuid4}.jpg"
+    conf_LDAP_SYNC_USER_PHOTO_WORKERS = 4  # Threads writing the photos to the storage. 0 writes them in the sync loop
     conf_LDAP_SYNC_USER_CHANGE_FIELDCASE = "lower"  # None,"lower","upper"
     conf_LDAP_SYNC_MULTIVALUE_SEPARATOR = "|"
+    conf_LDAP_SYNC_DECODE_CACHE_SIZE = 4096  # Distinct attribute values kept decoded, as many repeat across users (managers, departments). 0 to disable
     conf_LDAP_SYNC_USERNAME_FIELD = None
     conf_LDAP_SYNC_REMOVED_USER_CALLBACKS = ['adldap_sync.callbacks.removed_user_deactivate']
+    conf_LDAP_SYNC_USER_SNAPSHOT_FILE = ''  # I.e. "/var/lib/django/adldap_snapshot.sqlite3". Empty to disable
+    conf_LDAP_SYNC_USER_CHECKPOINT_FILE = ''  # I.e. "/var/lib/django/adldap_checkpoint.json". Progress of full syncs, for syncldap resume
+    conf_LDAP_SYNC_USER_CHECKPOINT_INTERVAL = 60  # Seconds between checkpoints
+    conf_LDAP_SYNC_USER_DN_RESOLVE = {}  # DN-valued attribute -> profile ForeignKey to the user model, i.e. {"manager": "manager_user"}
 
     #GROUPS
     conf_LDAP_SYNC_GROUP = True
@@ -65,6 +114,8 @@ class Command(BaseCommand):
     conf_LDAP_SYNC_GROUP_FILTER_INCREMENTAL = '(&(objectClass=group)(whenchanged>=?))'
     conf_LDAP_SYNC_GROUP_ATTRIBUTES = {"cn": "name"}
     conf_LDAP_SYNC_GROUP_REMOVAL_ACTION = 'KEEP'
+    conf_LDAP_SYNC_GROUP_ALLOW = []  # Group name patterns to sync, where * matches anything, i.e. ["App-*", "Staff"]. Empty allows all
+    conf_LDAP_SYNC_GROUP_DENY = []  # Group name patterns never synced, even if allowed
 
     #GROUP MEMBERSHIP
     conf_LDAP_SYNC_GROUP_MEMBERSHIP = True
@@ -72,6 +123,25 @@ class Command(BaseCommand):
     conf_LDAP_SYNC_GROUP_MEMBERSHIP_FILTER = '(member:1.2.840.113556.1.4.1941:={distinguishedName})'
     conf_LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS = True
     conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT = []  # [('CN=Domain Users,CN=Users,DC=example,DC=com', {'cn': [b'Domain Users']}),]
+    conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH = False  # Resolve nested groups locally from memberOf, instead of a LDAP_SYNC_GROUP_MEMBERSHIP_FILTER search per user
+    conf_LDAP_SYNC_GROUP_GRAPH_FILE = ''  # JSON file caching the group graph between runs. I.e. "/var/lib/django/adldap_groups.json"
+
+    #MULTIPLE SOURCES
+    conf_LDAP_SYNC_SOURCES = []  # [{'NAME': 'emea', 'BIND_URI': [...], 'BIND_SEARCH': '...'}, ...] Synced concurrently, the first ones win on username collisions
+
+    #DATABASE
+    conf_LDAP_SYNC_BULK_BATCH_SIZE = 500  # Rows per bulk query
+    conf_LDAP_SYNC_SEND_SIGNALS = True  # False writes the updates with queryset update(), without pre_save/post_save signals
+    conf_LDAP_SYNC_ERROR_JOURNAL = True  # Record the entries that failed in ADldap_SyncError, for 'syncldap retry'
+
+    #ASYNC ENGINE
+    conf_LDAP_SYNC_ASYNC_CONCURRENCY = 4  # Concurrent LDAP searches per server with --engine=async
+
+    #LOCKING
+    conf_LDAP_SYNC_LOCK = True  # Never run two syncs at the same time
+    conf_LDAP_SYNC_LOCK_CACHE = 'default'  # Django cache holding the lock. It must be shared by all the workers
+    conf_LDAP_SYNC_LOCK_TIMEOUT = 300  # Seconds without heartbeat before the lock of a dead sync is taken over
+    conf_LDAP_SYNC_LOCK_WAIT = 0  # Seconds to wait for a running sync. 0 skips the run
 
     #INCREMENTAL
     conf_LDAP_SYNC_INCREMENTAL_BETWEEN_FULL = 5
@@ -88,21 +158,64 @@ class Command(BaseCommand):
     stats_user_updated = 0
     stats_user_deleted = 0
     stats_user_errors = 0
+    stats_user_unchanged = 0
     stats_membership_total = 0
     stats_membership_added = 0
     stats_membership_deleted = 0
     stats_membership_errors = 0
+    stats_lock_wait = 0
+    #Validated settings of each (syncType, source), shared by the commands of this process. See clear_config_cache
+    config_cache = {}
     #Other Sync Variables
     whenchanged = datetime.utcnow()
     working_uri = None
     working_adldap_sync = None
+    working_uri_lock = threading.Lock()
+    page_tuners = {}  # uri -> PageSizeTuner
+    membership_cache = None  # user DN -> (uri, groups), prefetched by the async engine
+    group_graph = None  # GroupGraph, with LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH
+    group_nesting = None  # Digest of the group nesting, when all the groups were searched. For the snapshot
+    snapshot = None  # LDAPSnapshot of the running users sync, with LDAP_SYNC_USER_SNAPSHOT_FILE
+    connection_pool = None  # LDAPConnectionPool keeping the connections open between searches
+    server_health = None  # ServerHealth, once the LDAP servers are ranked
+    force_full = False
+    users_full_search = False
+    targeted_sync = False  # Only some users are synced (sync_ldap_usernames), without the state of the whole runs
+    users_shard = None  # Shard of all the users returned by the users search, besides the changed ones
+    checkpoint_state = None  # State of the interrupted sync being resumed
+    group_pks = None  # Lowercased name -> pk of the Django groups, fetched once per run for the membership sync
+    users_estimate = None  # Users the search is expected to return, for the progress ETA
+    photo_uploader = None  # PhotoUploader of the running sync
+    decode_cache = None  # DecodeCache of the attribute values
+    dn_resolver = None  # DNResolver of the running sync, with LDAP_SYNC_USER_DN_RESOLVE
+    error_journal = None  # ErrorJournal of the running sync, with LDAP_SYNC_ERROR_JOURNAL
+    capture = None  # SearchCapture recording the LDAP searches, with --capture
+    source = {}  # Settings of the LDAP_SYNC_SOURCES entry this command syncs
+    entry_sources = {}  # LDAPEntryType -> source command, while the entries of several sources are applied
+    stats_sources = None  # Username or group DN -> source command, whose statistics are counted too. See add_stat()
+    photo_counted_usernames = set()  # Users already counted as updated, since the last photo uploads were attached
 
     def add_arguments(self, parser):
         # Positional arguments
         parser.add_argument('syncType', nargs='?', type=str, default='')
+        parser.add_argument('--engine', choices=['sync', 'async'], default='sync',
+                            help='async runs the LDAP searches concurrently with the database writes')
+        parser.add_argument('--capture', metavar='FILE', default='',
+                            help='Write the results of the LDAP searches to a gzipped file, for --replay')
+        parser.add_argument('--replay', metavar='FILE', default='',
+                            help='Sync the entries of a --capture file instead of searching LDAP, and report the database throughput')
+        parser.add_argument('--reload-config', action='store_true', dest='reload_config',
+                            help='Validate the settings again, instead of using the ones cached by a previous run of this process')
+
+    def get_setting(self, attrname, defaultvalue):
+        """A setting, overridden by the LDAP source this command syncs."""
+        name = attrname[len('LDAP_SYNC_'):]
+        if ((name in self.SOURCE_SETTINGS) and (name in self.source)):
+            return self.source[name]
+        return getattr(settings, attrname, defaultvalue)
 
     def load_stringconfig(self, attrname, defaultvalue, canbeEmpty=False):
-        result = getattr(settings, attrname, defaultvalue)
+        result = self.get_setting(attrname, defaultvalue)
         if ((not canbeEmpty) and ((result is None) or (result == ''))):
             error_msg = ("%s must be specified in your Django settings file" % attrname)
             raise ImproperlyConfigured(error_msg)
@@ -112,14 +225,14 @@ class Command(BaseCommand):
         return result
 
     def load_boolconfig(self, attrname, defaultvalue):
-        result = getattr(settings, attrname, defaultvalue)
+        result = self.get_setting(attrname, defaultvalue)
         if (not isinstance(result, bool)):
             error_msg = ("%s must be a Boolean" % attrname)
             raise ImproperlyConfigured(error_msg)
         return result
 
     def load_listconfig(self, attrname, defaultvalue, canbeEmpty=False):
-        result = getattr(settings, attrname, defaultvalue)
+        result = self.get_setting(attrname, defaultvalue)
         if (not isinstance(result, list)):
             error_msg = ("%s must be an array or list: ['a','b',....]" % attrname)
             raise ImproperlyConfigured(error_msg)
@@ -129,7 +242,7 @@ class Command(BaseCommand):
         return result
 
     def load_dictconfig(self, attrname, defaultvalue, canbeEmpty=False):
-        result = getattr(settings, attrname, defaultvalue)
+        result = self.get_setting(attrname, defaultvalue)
         if (not isinstance(result, dict)):
             error_msg = ("%s must be a dictionary: {'a':'valuea','b':'valueb',....}" % attrname)
             raise ImproperlyConfigured(error_msg)
@@ -138,28 +251,118 @@ class Command(BaseCommand):
             raise ImproperlyConfigured(error_msg)
         return result
 
+    def load_numberconfig(self, attrname, defaultvalue, minvalue=None, maxvalue=None):
+        result = self.get_setting(attrname, defaultvalue)
+        if ((not isinstance(result, (int, float))) or isinstance(result, bool)):
+            error_msg = ("%s must be a number" % attrname)
+            raise ImproperlyConfigured(error_msg)
+        if (((minvalue is not None) and (result < minvalue)) or ((maxvalue is not None) and (result > maxvalue))):
+            error_msg = ("%s must be between %s and %s" % (attrname, minvalue, maxvalue))
+            raise ImproperlyConfigured(error_msg)
+        return result
+
+    @classmethod
+    def clear_config_cache(cls):
+        """Forget the validated settings, so the next run of this process reads them again."""
+        cls.config_cache.clear()
+
     def load_config(self, *args, **options):
-        forceFull = (options['syncType'].lower() == 'full')
-        forceIncremental = (options['syncType'].lower() == 'incremental')
+        """
+        Load the config of a run. The validated settings are cached per process,
+        see config_cache, so only the state of the run is set up each time.
+        With reload_config, they are read and validated again.
+        """
+        if (options.get('reload_config')):
+            self.clear_config_cache()
+        syncType = options['syncType'].lower()
+        key = (syncType, self.source.get('NAME'))
+        config = self.config_cache.get(key)
+        if (config is None):
+            self.load_settings(syncType)
+            #Copies, as some lists are reordered during a run (i.e. LDAP_SYNC_BIND_URI)
+            config = dict((name, copy.copy(value)) for name, value in vars(self).items() if name.startswith('conf_'))
+            self.config_cache[key] = config
+        else:
+            for name, value in config.items():
+                setattr(self, name, copy.copy(value))
+
+        forceFull = (syncType == 'full')
+        forceIncremental = (syncType == 'incremental')
+        forceResume = (syncType == 'resume')
+        self.force_full = forceFull
+        self.targeted_sync = False
+        self.page_tuners = {}
+        self.server_health = None
+        self.group_pks = None
+        self.stats_sources = {}
+        self.group_nesting = None
+        self.snapshot = None
+        self.decode_cache = DecodeCache(int(self.conf_LDAP_SYNC_DECODE_CACHE_SIZE), self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR)
+        self.error_journal = (ErrorJournal(self.conf_LDAP_SYNC_BULK_BATCH_SIZE) if self.conf_LDAP_SYNC_ERROR_JOURNAL else None)
+        #We take out N minutes to avoid any time drift or different times for sync.
+        self.whenchanged = datetime.utcnow().replace(tzinfo=pytz.utc) - timedelta(minutes=self.conf_LDAP_SYNC_INCREMENTAL_TIME_OFFSET)
+        self.query = LDAPQueryBuilder(self)
+        self.checkpoint_state = None
+        if (forceResume):
+            self.checkpoint_state = self.load_checkpoint()
+        msgLoaded = "Config loaded correctly"
+        if (forceFull):
+            msgLoaded += ": Forcing a FULL Sync"
+        if (forceIncremental):
+            msgLoaded += ": Forcing an Incremental Sync"
+        if (self.checkpoint_state is not None):
+            msgLoaded += ": Resuming an interrupted Sync"
+        logger.debug(msgLoaded)
+
+    def load_settings(self, syncType):
+        """
+        Read and validate the settings into the conf_ attributes. The result is
+        cached for the whole life of the process: the cache is only cleared by
+        Django's setting_changed signal, which is sent by override_settings (tests),
+        not when the settings of a running worker change. Use clear_config_cache().
+        """
+        forceFull = (syncType == 'full')
+        forceIncremental = (syncType == 'incremental')
+
+        #Each source is loaded by its own command, see MultiSourceSync
+        self.conf_LDAP_SYNC_SOURCES = []
+        if (not self.source):
+            self.conf_LDAP_SYNC_SOURCES = self.load_listconfig('LDAP_SYNC_SOURCES', self.conf_LDAP_SYNC_SOURCES, True)
+            for definition in self.conf_LDAP_SYNC_SOURCES:
+                if ((not isinstance(definition, dict)) or (not definition.get('NAME')) or (not definition.get('BIND_URI'))):
+                    raise ImproperlyConfigured("Each LDAP_SYNC_SOURCES entry must be a dictionary with a NAME and a BIND_URI")
+                unknown = set(definition) - set(self.SOURCE_SETTINGS) - set(['NAME'])
+                if (unknown):
+                    raise ImproperlyConfigured("LDAP_SYNC_SOURCES '%s': invalid settings %s. Valid ones are NAME, %s" % (definition['NAME'], ", ".join(sorted(unknown)), ", ".join(self.SOURCE_SETTINGS)))
 
         self.conf_LDAP_SYNC_BIND_URI = []
-        uri = getattr(settings, 'LDAP_SYNC_BIND_URI', '')
+        uri = self.get_setting('LDAP_SYNC_BIND_URI', '')
         #Add URIs either as string or as array of strings
         if (isinstance(uri, str)):
             self.conf_LDAP_SYNC_BIND_URI.append(uri)
         else:
             for n_uri in uri:
                 self.conf_LDAP_SYNC_BIND_URI.append(n_uri)
-        if (len(self.conf_LDAP_SYNC_BIND_URI) == 0):
+        if ((len(self.conf_LDAP_SYNC_BIND_URI) == 0) and (not self.conf_LDAP_SYNC_SOURCES)):
             error_msg = "LDAP_SYNC_BIND_URI must be specified in your Django settings file"
             raise ImproperlyConfigured(error_msg)
 
-        self.conf_LDAP_SYNC_BIND_DN = self.load_stringconfig('LDAP_SYNC_BIND_DN', self.conf_LDAP_SYNC_BIND_DN)
-        self.conf_LDAP_SYNC_BIND_PASS = self.load_stringconfig('LDAP_SYNC_BIND_PASS', self.conf_LDAP_SYNC_BIND_PASS)
-        self.conf_LDAP_SYNC_BIND_SEARCH = self.load_stringconfig('LDAP_SYNC_BIND_SEARCH', self.conf_LDAP_SYNC_BIND_SEARCH)
+        #With LDAP_SYNC_SOURCES, the connection settings are only needed on each source
+        self.conf_LDAP_SYNC_BIND_DN = self.load_stringconfig('LDAP_SYNC_BIND_DN', self.conf_LDAP_SYNC_BIND_DN, bool(self.conf_LDAP_SYNC_SOURCES))
+        self.conf_LDAP_SYNC_BIND_PASS = self.load_stringconfig('LDAP_SYNC_BIND_PASS', self.conf_LDAP_SYNC_BIND_PASS, bool(self.conf_LDAP_SYNC_SOURCES))
+        self.conf_LDAP_SYNC_BIND_SEARCH = self.load_stringconfig('LDAP_SYNC_BIND_SEARCH', self.conf_LDAP_SYNC_BIND_SEARCH, bool(self.conf_LDAP_SYNC_SOURCES))
         self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR = self.load_stringconfig('LDAP_SYNC_MULTIVALUE_SEPARATOR', self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR)
-
-        #self.conf_LDAP_SYNC_BIND_PAGESIZE = 200#Not used in this class
+        self.conf_LDAP_SYNC_DECODE_CACHE_SIZE = self.load_numberconfig('LDAP_SYNC_DECODE_CACHE_SIZE', self.conf_LDAP_SYNC_DECODE_CACHE_SIZE, 0)
+
+        self.conf_LDAP_SYNC_BIND_PAGESIZE = max(10, self.load_numberconfig('LDAP_SYNC_BIND_PAGESIZE', self.conf_LDAP_SYNC_BIND_PAGESIZE))
+        self.conf_LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE = self.load_boolconfig('LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE', self.conf_LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE)
+        self.conf_LDAP_SYNC_BIND_MAXPAGESIZE = self.load_numberconfig('LDAP_SYNC_BIND_MAXPAGESIZE', self.conf_LDAP_SYNC_BIND_MAXPAGESIZE, PageSizeTuner.MIN_PAGESIZE)
+        self.conf_LDAP_SYNC_BIND_PAGE_MAXBYTES = self.load_numberconfig('LDAP_SYNC_BIND_PAGE_MAXBYTES', self.conf_LDAP_SYNC_BIND_PAGE_MAXBYTES, 1)
+        self.conf_LDAP_SYNC_BIND_TIMEOUT = self.load_numberconfig('LDAP_SYNC_BIND_TIMEOUT', self.conf_LDAP_SYNC_BIND_TIMEOUT, 0.1)
+        self.conf_LDAP_SYNC_BIND_HEALTH_CACHE = self.load_stringconfig('LDAP_SYNC_BIND_HEALTH_CACHE', self.conf_LDAP_SYNC_BIND_HEALTH_CACHE, True)
+        if (self.conf_LDAP_SYNC_BIND_HEALTH_CACHE and (self.conf_LDAP_SYNC_BIND_HEALTH_CACHE not in settings.CACHES)):
+            raise ImproperlyConfigured("LDAP_SYNC_BIND_HEALTH_CACHE invalid: %s is not in CACHES" % self.conf_LDAP_SYNC_BIND_HEALTH_CACHE)
+        self.conf_LDAP_SYNC_BIND_HEALTH_TTL = self.load_numberconfig('LDAP_SYNC_BIND_HEALTH_TTL', self.conf_LDAP_SYNC_BIND_HEALTH_TTL, 1)
         self.conf_LDAP_SYNC_USER = self.load_boolconfig('LDAP_SYNC_USER', self.conf_LDAP_SYNC_USER)
 
         #User Sync Config
@@ -172,15 +375,18 @@ class Command(BaseCommand):
             if (forceIncremental):
                 self.conf_LDAP_SYNC_USER_INCREMENTAL = True
             self.conf_LDAP_SYNC_USER_FILTER_INCREMENTAL = self.load_stringconfig('LDAP_SYNC_USER_FILTER_INCREMENTAL', self.conf_LDAP_SYNC_USER_FILTER_INCREMENTAL, (not self.conf_LDAP_SYNC_USER_INCREMENTAL))
+            self.conf_LDAP_SYNC_USER_SHARDS = int(self.load_numberconfig('LDAP_SYNC_USER_SHARDS', self.conf_LDAP_SYNC_USER_SHARDS, 0, len(LDAPQueryBuilder.SHARD_CHARACTERS)))
+            if (self.conf_LDAP_SYNC_USER_SHARDS == 1):
+                self.conf_LDAP_SYNC_USER_SHARDS = 0
             self.conf_LDAP_SYNC_USER_SHOW_PROGRESS = self.load_boolconfig('LDAP_SYNC_USER_SHOW_PROGRESS', self.conf_LDAP_SYNC_USER_SHOW_PROGRESS)
+            self.conf_LDAP_SYNC_PROGRESS_COUNT = self.load_boolconfig('LDAP_SYNC_PROGRESS_COUNT', self.conf_LDAP_SYNC_PROGRESS_COUNT)
             self.conf_LDAP_SYNC_USER_SET_UNUSABLE_PASSWORD = self.load_boolconfig('LDAP_SYNC_USER_SET_UNUSABLE_PASSWORD', self.conf_LDAP_SYNC_USER_SET_UNUSABLE_PASSWORD)
+            #The attributes needed by the sync itself are added by the LDAPQueryBuilder, see get_required_user_attributes()
             self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES = self.load_listconfig('LDAP_SYNC_USER_EXTRA_ATTRIBUTES', self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES, True)
-            #We need the userAccountControl attribute for Disabling check, so we added it if missing on the ldap query
-            if (self.ATTRIBUTE_DISABLED not in self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES):
-                self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES.append(self.ATTRIBUTE_DISABLED)
             self.conf_LDAP_SYNC_USER_EXTRA_PROFILES = self.load_listconfig('LDAP_SYNC_USER_EXTRA_PROFILES', self.conf_LDAP_SYNC_USER_EXTRA_PROFILES, True)
             self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC = self.load_listconfig('LDAP_SYNC_USER_EXEMPT_FROM_SYNC', self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC, True)
-            self.conf_LDAP_SYNC_USER_CALLBACKS = self.load_listconfig('LDAP_LDAP_SYNC_USER_CALLBACKS', self.conf_LDAP_SYNC_USER_CALLBACKS, True)
+            #LDAP_LDAP_SYNC_USER_CALLBACKS is the name older versions read by mistake
+            self.conf_LDAP_SYNC_USER_CALLBACKS = self.load_listconfig('LDAP_SYNC_USER_CALLBACKS', getattr(settings, 'LDAP_LDAP_SYNC_USER_CALLBACKS', self.conf_LDAP_SYNC_USER_CALLBACKS), True)
             self.conf_LDAP_SYNC_USER_ATTRIBUTES = self.load_dictconfig('LDAP_SYNC_USER_ATTRIBUTES', self.conf_LDAP_SYNC_USER_ATTRIBUTES)
             username_field = getattr(get_user_model(), 'USERNAME_FIELD', 'username')
             self.conf_LDAP_SYNC_USERNAME_FIELD = self.load_stringconfig('LDAP_SYNC_USERNAME_FIELD', username_field)
@@ -188,12 +394,23 @@ class Command(BaseCommand):
                 error_msg = ("LDAP_SYNC_USER_ATTRIBUTES must contain the field '%s'" % self.conf_LDAP_SYNC_USERNAME_FIELD)
                 raise ImproperlyConfigured(error_msg)
             self.conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME = self.load_stringconfig('LDAP_SYNC_USER_THUMBNAILPHOTO_NAME', self.conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME)
-            self.conf_LDAP_SYNC_USER_REMOVAL_ACTION = self.load_stringconfig('LDAP_SYNC_USER_REMOVAL_ACTION', self.conf_LDAP_SYNC_USER_REMOVAL_ACTION)
+            self.conf_LDAP_SYNC_USER_PHOTO_WORKERS = self.load_numberconfig('LDAP_SYNC_USER_PHOTO_WORKERS', self.conf_LDAP_SYNC_USER_PHOTO_WORKERS, 0)
+            self.conf_LDAP_SYNC_USER_REMOVAL_ACTION = self.load_stringconfig('LDAP_SYNC_USER_REMOVAL_ACTION', self.conf_LDAP_SYNC_USER_REMOVAL_ACTION).upper()
+            if (self.conf_LDAP_SYNC_USER_REMOVAL_ACTION not in self.REMOVAL_ACTIONS):
+                error_msg = ("LDAP_SYNC_USER_REMOVAL_ACTION invalid: %s. Valid values are %s" % (self.conf_LDAP_SYNC_USER_REMOVAL_ACTION, ", ".join(self.REMOVAL_ACTIONS)))
+                raise ImproperlyConfigured(error_msg)
+            self.conf_LDAP_SYNC_USER_REMOVAL_THRESHOLD = self.load_numberconfig('LDAP_SYNC_USER_REMOVAL_THRESHOLD', self.conf_LDAP_SYNC_USER_REMOVAL_THRESHOLD, 0, 1)
             self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS = self.load_listconfig('LDAP_SYNC_REMOVED_USER_CALLBACKS', self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS, True)
             self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE = self.load_stringconfig('LDAP_SYNC_USER_CHANGE_FIELDCASE', self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE, True)
             if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE) and ((self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE != "lower") and (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE != "upper")):
                 error_msg = ("LDAP_SYNC_USER_CHANGE_FIELDCASE invalid: %s. Valid values are None, 'lower' or 'upper'" % self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE)
                 raise ImproperlyConfigured(error_msg)
+            self.conf_LDAP_SYNC_USER_DN_RESOLVE = self.load_dictconfig('LDAP_SYNC_USER_DN_RESOLVE', self.conf_LDAP_SYNC_USER_DN_RESOLVE, True)
+            for name, field in self.conf_LDAP_SYNC_USER_DN_RESOLVE.items():
+                related = [apps.get_model(profile)._meta.get_field(field).related_model for profile in self.conf_LDAP_SYNC_USER_EXTRA_PROFILES
+                           if LDAPQueryBuilder.has_field(apps.get_model(profile), field)]
+                if ((not related) or any(model != get_user_model() for model in related)):
+                    raise ImproperlyConfigured("LDAP_SYNC_USER_DN_RESOLVE: '%s' must be a ForeignKey to the user model on a LDAP_SYNC_USER_EXTRA_PROFILES model" % field)
 
         #Group Sync config
         self.conf_LDAP_SYNC_GROUP = self.load_boolconfig('LDAP_SYNC_GROUP', self.conf_LDAP_SYNC_GROUP)
@@ -212,40 +429,195 @@ class Command(BaseCommand):
                 error_msg = "LDAP_SYNC_GROUP_ATTRIBUTES must contain the field '%s'" % groupname_field
                 raise ImproperlyConfigured(error_msg)
             self.conf_LDAP_SYNC_GROUP_REMOVAL_ACTION = self.load_stringconfig('LDAP_SYNC_GROUP_REMOVAL_ACTION', self.conf_LDAP_SYNC_GROUP_REMOVAL_ACTION)
+        #Both the groups and the membership are restricted to the allowed groups
+        self.conf_LDAP_SYNC_GROUP_ALLOW = self.load_listconfig('LDAP_SYNC_GROUP_ALLOW', self.conf_LDAP_SYNC_GROUP_ALLOW, True)
+        self.conf_LDAP_SYNC_GROUP_DENY = self.load_listconfig('LDAP_SYNC_GROUP_DENY', self.conf_LDAP_SYNC_GROUP_DENY, True)
+        for pattern in (self.conf_LDAP_SYNC_GROUP_ALLOW + self.conf_LDAP_SYNC_GROUP_DENY):
+            if ((not isinstance(pattern, str)) or (not pattern)):
+                raise ImproperlyConfigured("LDAP_SYNC_GROUP_ALLOW and LDAP_SYNC_GROUP_DENY must be lists of group name patterns")
 
         #Group Membership Config
         self.conf_LDAP_SYNC_GROUP_MEMBERSHIP = self.load_boolconfig('LDAP_SYNC_GROUP_MEMBERSHIP', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP)
         if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP):
             self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD = self.load_stringconfig('LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD)
-            if ((self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD is not None) and (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD not in self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES)):
-                self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES.append(self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD)
             self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_FILTER = self.load_stringconfig('LDAP_SYNC_GROUP_MEMBERSHIP_FILTER', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_FILTER)
             self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS = self.load_boolconfig('LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS)
             self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT = self.load_listconfig('LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT, True)
-
+            self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH = self.load_boolconfig('LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH', self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH)
+            if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH and (not self.conf_LDAP_SYNC_GROUP)):
+                raise ImproperlyConfigured("LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH needs LDAP_SYNC_GROUP, the graph is built from the synced groups")
+            self.conf_LDAP_SYNC_GROUP_GRAPH_FILE = self.load_stringconfig('LDAP_SYNC_GROUP_GRAPH_FILE', self.conf_LDAP_SYNC_GROUP_GRAPH_FILE, True)
+            if (self.source and self.conf_LDAP_SYNC_GROUP_GRAPH_FILE and ('GROUP_GRAPH_FILE' not in self.source)):
+                raise ImproperlyConfigured("LDAP_SYNC_SOURCES '%s': each source needs its own GROUP_GRAPH_FILE" % self.source['NAME'])
+
+        #Snapshot of the last applied state. Entries are keyed by objectGUID
+        if (self.conf_LDAP_SYNC_USER):
+            self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE = self.load_stringconfig('LDAP_SYNC_USER_SNAPSHOT_FILE', self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE, True)
+            self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE = self.load_stringconfig('LDAP_SYNC_USER_CHECKPOINT_FILE', self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE, True)
+            if (self.conf_LDAP_SYNC_SOURCES or self.source):
+                #The checkpoint can't hold the position of each source
+                self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE = ''
+            self.conf_LDAP_SYNC_USER_CHECKPOINT_INTERVAL = self.load_numberconfig('LDAP_SYNC_USER_CHECKPOINT_INTERVAL', self.conf_LDAP_SYNC_USER_CHECKPOINT_INTERVAL, 0)
+
+        self.conf_LDAP_SYNC_BULK_BATCH_SIZE = self.load_numberconfig('LDAP_SYNC_BULK_BATCH_SIZE', self.conf_LDAP_SYNC_BULK_BATCH_SIZE, 1)
+        self.conf_LDAP_SYNC_SEND_SIGNALS = self.load_boolconfig('LDAP_SYNC_SEND_SIGNALS', self.conf_LDAP_SYNC_SEND_SIGNALS)
+        self.conf_LDAP_SYNC_ERROR_JOURNAL = self.load_boolconfig('LDAP_SYNC_ERROR_JOURNAL', self.conf_LDAP_SYNC_ERROR_JOURNAL)
+        self.conf_LDAP_SYNC_PROGRESS_CACHE = self.load_stringconfig('LDAP_SYNC_PROGRESS_CACHE', self.conf_LDAP_SYNC_PROGRESS_CACHE, True)
+        if (self.conf_LDAP_SYNC_PROGRESS_CACHE and (self.conf_LDAP_SYNC_PROGRESS_CACHE not in settings.CACHES)):
+            raise ImproperlyConfigured("LDAP_SYNC_PROGRESS_CACHE invalid: %s is not in CACHES" % self.conf_LDAP_SYNC_PROGRESS_CACHE)
+        self.conf_LDAP_SYNC_ASYNC_CONCURRENCY = self.load_numberconfig('LDAP_SYNC_ASYNC_CONCURRENCY', self.conf_LDAP_SYNC_ASYNC_CONCURRENCY, 1)
+        self.conf_LDAP_SYNC_LOCK = self.load_boolconfig('LDAP_SYNC_LOCK', self.conf_LDAP_SYNC_LOCK)
+        if (self.conf_LDAP_SYNC_LOCK):
+            self.conf_LDAP_SYNC_LOCK_CACHE = self.load_stringconfig('LDAP_SYNC_LOCK_CACHE', self.conf_LDAP_SYNC_LOCK_CACHE)
+            if (self.conf_LDAP_SYNC_LOCK_CACHE not in settings.CACHES):
+                raise ImproperlyConfigured("LDAP_SYNC_LOCK_CACHE invalid: %s is not in CACHES" % self.conf_LDAP_SYNC_LOCK_CACHE)
+            if (settings.CACHES[self.conf_LDAP_SYNC_LOCK_CACHE].get('BACKEND', '').endswith('LocMemCache')):
+                logger.warning("LDAP_SYNC_LOCK_CACHE '%s' is local to each process, so it won't prevent syncs overlapping on other workers" % self.conf_LDAP_SYNC_LOCK_CACHE)
+            self.conf_LDAP_SYNC_LOCK_TIMEOUT = self.load_numberconfig('LDAP_SYNC_LOCK_TIMEOUT', self.conf_LDAP_SYNC_LOCK_TIMEOUT, 10)
+            self.conf_LDAP_SYNC_LOCK_WAIT = self.load_numberconfig('LDAP_SYNC_LOCK_WAIT', self.conf_LDAP_SYNC_LOCK_WAIT, 0)
         self.conf_LDAP_SYNC_INCREMENTAL_BETWEEN_FULL = getattr(settings, 'LDAP_SYNC_INCREMENTAL_BETWEEN_FULL', self.conf_LDAP_SYNC_INCREMENTAL_BETWEEN_FULL)
         self.conf_LDAP_SYNC_INCREMENTAL_TIME_OFFSET = getattr(settings, 'LDAP_SYNC_INCREMENTAL_TIME_OFFSET', self.conf_LDAP_SYNC_INCREMENTAL_TIME_OFFSET)
         self.conf_LDAP_SYNC_INCREMENTAL_TIMESTAMPFORMAT = self.load_stringconfig('LDAP_SYNC_INCREMENTAL_TIMESTAMPFORMAT', self.conf_LDAP_SYNC_INCREMENTAL_TIMESTAMPFORMAT)
-        #We take out N minutes to avoid any time drift or different times for sync.
-        self.whenchanged = datetime.utcnow().replace(tzinfo=pytz.utc) - timedelta(minutes=self.conf_LDAP_SYNC_INCREMENTAL_TIME_OFFSET)
-        msgLoaded = "Config loaded correctly"
-        if (forceFull):
-            msgLoaded += ": Forcing a FULL Sync"
-        if (forceIncremental):
-            msgLoaded += ": Forcing an Incremental Sync"
-        logger.debug(msgLoaded)
+
+    def load_checkpoint(self):
+        """
+        State of the interrupted full sync to resume. The users search is full
+        again, and the entries already applied are skipped.
+        """
+        if ((not self.conf_LDAP_SYNC_USER) or (not self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE)):
+            logger.warning("Nothing to resume: LDAP_SYNC_USER_CHECKPOINT_FILE is not set")
+            return None
+        state = SyncCheckpoint(self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE, self.get_checkpoint_fingerprint()).load()
+        if (state is None):
+            logger.info("No checkpoint to resume, running a normal sync")
+            return None
+        self.conf_LDAP_SYNC_USER_INCREMENTAL = False
+        #Keep the timestamp of the interrupted sync, so the changes made since then are picked up by the next incremental
+        self.whenchanged = datetime.fromtimestamp(state['whenchanged'], pytz.utc)
+        return state
 
     def handle(self, *args, **options):
         self.load_config(*args, **options)
 
-        uri_groups_server, ldap_groups = self.get_ldap_groups()
-        if ldap_groups:
+        lock = None
+        if (self.conf_LDAP_SYNC_LOCK):
+            lock = SyncLock(self.LOCK_KEY, self.conf_LDAP_SYNC_LOCK_CACHE, self.conf_LDAP_SYNC_LOCK_TIMEOUT)
+            started = time.time()
+            acquired = lock.acquire(self.conf_LDAP_SYNC_LOCK_WAIT)
+            self.stats_lock_wait = time.time() - started
+            if (not acquired):
+                logger.warning("Another synchronization is running, skipping this one (waited %.1fs)" % self.stats_lock_wait)
+                return
+        try:
+            #Inside the try, so the lock is released if the capture file can't be written
+            if (options.get('capture')):
+                if (self.conf_LDAP_SYNC_SOURCES):
+                    logger.warning("--capture is not available with LDAP_SYNC_SOURCES, the searches won't be captured")
+                else:
+                    self.capture = SearchCapture(options['capture'])
+            if (options.get('replay')):
+                ReplaySync(self, options['replay']).run()
+                return
+            if (options['syncType'].lower() == 'retry'):
+                self.retry_failed_entries()
+                return
+            if (self.conf_LDAP_SYNC_SOURCES):
+                #Sources are already searched concurrently, and each one keeps its own sync record
+                MultiSourceSync(self, options['syncType']).run()
+                return
+            if (options.get('engine') == 'async'):
+                uri_groups_server, uri_users_server = AsyncSyncEngine(self).run()
+            else:
+                uri_groups_server, ldap_groups = self.get_ldap_groups()
+                if ldap_groups:
+                    self.sync_ldap_groups(ldap_groups)
+
+                uri_users_server, ldap_users = self.get_ldap_users()
+                if ldap_users:
+                    self.sync_ldap_users(ldap_users)
+
+            self.save_ldap_sync(uri_groups_server, uri_users_server)
+        finally:
+            if (self.capture is not None):
+                self.capture.close()
+                self.capture = None
+            if (lock is not None):
+                lock.release()
+
+    def retry_failed_entries(self):
+        """
+        Search again the entries of the error journal, with one LDAP search per
+        chunk of DNs, and apply them. The incremental sync timestamps aren't touched.
+        """
+        if (self.error_journal is None):
+            logger.warning("Nothing to retry: LDAP_SYNC_ERROR_JOURNAL is disabled")
+            return
+        group_dns, user_dns = set(), set()
+        for journaled in ADldap_SyncError.objects.all():
+            (group_dns if (journaled.entry_type == 'group') else user_dns).add(journaled.dn)
+        if ((not group_dns) and (not user_dns)):
+            logger.info("Nothing to retry: the error journal is empty")
+            return
+        #With LDAP_SYNC_SOURCES, the entries are searched on every source
+        searchers = ([self] if (not self.conf_LDAP_SYNC_SOURCES) else MultiSourceSync(self).sources)
+        self.users_full_search = False
+        self.load_cached_group_graph()
+
+        searched_dns, found_dns = set(), set()
+        if (group_dns and self.conf_LDAP_SYNC_GROUP):
+            searched_dns.update(group_dns)
+            ldap_groups = []
+            for searcher in searchers:
+                for chunk in chunked(sorted(group_dns), self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                    group_filter = '(&%s%s)' % (searcher.query.group_filter(searcher.conf_LDAP_SYNC_GROUP_FILTER), searcher.query.dns_filter(chunk))
+                    uri, groups = searcher.ldap_search(group_filter, searcher.query.group_attributes, False, group_filter)
+                    ldap_groups.extend((dn, attributes) for dn, attributes in groups if isinstance(attributes, dict))
+            found_dns.update(dn for dn, attributes in ldap_groups)
             self.sync_ldap_groups(ldap_groups)
-
-        uri_users_server, ldap_users = self.get_ldap_users()
-        if ldap_users:
-            self.sync_ldap_users(ldap_users)
-
+        if (user_dns and self.conf_LDAP_SYNC_USER):
+            searched_dns.update(user_dns)
+            ldap_users = []
+            for searcher in searchers:
+                for chunk in chunked(sorted(user_dns), self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                    users_filter = '(&%s%s)' % (searcher.conf_LDAP_SYNC_USER_FILTER, searcher.query.dns_filter(chunk))
+                    uri, users = searcher.ldap_search(users_filter, searcher.query.user_attributes, False, users_filter, searcher.query.user_entry_type)
+                    ldap_users.extend(users)
+            found_dns.update(entry.dn for entry in ldap_users)
+            self.entry_sources = dict((searcher.query.user_entry_type, searcher) for searcher in searchers if (searcher is not self))
+            try:
+                self.sync_ldap_users(ldap_users)
+            finally:
+                self.entry_sources = {}
+
+        #Entries gone from LDAP (or out of the filters) are left to the removal of the full syncs
+        missing_dns = list(searched_dns - found_dns)
+        for chunk in chunked(missing_dns, self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            ADldap_SyncError.objects.filter(dn__in=chunk).delete()
+        logger.info("Retried %d failed entries: %d found in LDAP, %d still failing" % (len(searched_dns), len(found_dns), ADldap_SyncError.objects.count()))
+
+    def journal_error(self, phase, dn, name, error):
+        """Record a failed entry in the error journal."""
+        if (self.error_journal is not None):
+            self.error_journal.error(phase, dn, name, error)
+
+    def journal_seen(self, entry_type, dn):
+        """An entry was applied, clearing its previous errors unless it fails again."""
+        if (self.error_journal is not None):
+            self.error_journal.seen(entry_type, dn)
+
+    def save_journal(self):
+        if (self.error_journal is not None):
+            self.error_journal.save()
+
+    def add_stat(self, name, key, count=1):
+        """Add to a statistic. With LDAP_SYNC_SOURCES, it's also added to the source of the user (or group DN) key."""
+        setattr(self, name, getattr(self, name) + count)
+        source = self.stats_sources.get(key)
+        if (source is not None):
+            setattr(source, name, getattr(source, name) + count)
+
+    def save_ldap_sync(self, uri_groups_server, uri_users_server):
+        """Update the statistics and the incremental sync timestamp of the LDAP server used."""
         if ((uri_groups_server == uri_users_server) and (uri_groups_server is not None)):
             #OK Both servers are the same so we can safely update its info
             adldap_sync, created = ADldap_Sync.objects.get_or_create(ldap_sync_uri=uri_groups_server)
@@ -266,8 +638,16 @@ class Command(BaseCommand):
             adldap_sync.last_sync_group_added = self.stats_group_added
             adldap_sync.last_sync_group_deleted = self.stats_group_deleted
             adldap_sync.last_sync_group_errors = self.stats_group_errors
-
-            if (adldap_sync.syncs_to_full == 0):
+            adldap_sync.last_sync_lock_wait = self.stats_lock_wait
+            if (self.users_full_search):
+                adldap_sync.last_full_sync_user_total = self.stats_user_total
+            if (self.users_shard is not None):
+                adldap_sync.user_shard = (self.users_shard + 1) % self.conf_LDAP_SYNC_USER_SHARDS
+
+            if (self.users_shard is not None):
+                #Only a shard of the users was searched: it's not a full sync, nor one of the incrementals between them
+                adldap_sync.last_sync_type = 'Shard'
+            elif (adldap_sync.syncs_to_full == 0):
                 adldap_sync.last_sync_type = 'Full'
                 adldap_sync.syncs_to_full = self.conf_LDAP_SYNC_INCREMENTAL_BETWEEN_FULL
             else:
@@ -276,34 +656,145 @@ class Command(BaseCommand):
                 if (adldap_sync.syncs_to_full >= 0):
                     adldap_sync.syncs_to_full -= 1
             adldap_sync.whenchanged = self.whenchanged
+            if (uri_users_server in self.page_tuners):
+                adldap_sync.page_size = self.page_tuners[uri_users_server].best_page_size
             adldap_sync.save()
-            logger.debug("Synchronization finished: Type:%s; Next Full sync in: %d syncs. Users (%d): A:%d U:%d D:%d Err:%d. Groups (%d): A:%d D:%d Err:%d. Memberships (%d): A:%d D:%d Err:%d" \
+            logger.debug("Synchronization finished: Type:%s; Next Full sync in: %d syncs. Users (%d): A:%d U:%d D:%d Err:%d. Groups (%d): A:%d D:%d Err:%d. Memberships (%d): A:%d D:%d Err:%d. Lock wait: %.1fs" \
                          % (adldap_sync.last_sync_type, adldap_sync.syncs_to_full, \
                            adldap_sync.last_sync_user_total, adldap_sync.last_sync_user_added, adldap_sync.last_sync_user_updated, adldap_sync.last_sync_user_deleted, adldap_sync.last_sync_user_errors, \
                            adldap_sync.last_sync_group_total, adldap_sync.last_sync_group_added, adldap_sync.last_sync_group_deleted, adldap_sync.last_sync_group_errors, \
-                           adldap_sync.last_sync_membership_total, adldap_sync.last_sync_membership_added, adldap_sync.last_sync_membership_deleted, adldap_sync.last_sync_membership_errors))
+                           adldap_sync.last_sync_membership_total, adldap_sync.last_sync_membership_added, adldap_sync.last_sync_membership_deleted, adldap_sync.last_sync_membership_errors, \
+                           adldap_sync.last_sync_lock_wait))
 
         else:
             if ((uri_groups_server is not None) or (uri_users_server is not None)):
                 logger.error("Both servers are not the same, or no Sync was attempted. Something must be misconfigured! Groups URI: %s, Users URI:%s" % (uri_groups_server, uri_users_server))
 
+    def get_required_user_attributes(self):
+        """User attributes needed by the sync itself, whatever the config maps."""
+        #We need the userAccountControl attribute for Disabling check
+        attributes = [self.ATTRIBUTE_DISABLED]
+        if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD):
+            attributes.append(self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD)
+        #memberOf holds the direct groups for the group graph. With the snapshot, direct membership changes also invalidate the entry
+        if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH or self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE)):
+            attributes.append(self.ATTRIBUTE_MEMBEROF)
+        if (self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE):
+            attributes.append(self.ATTRIBUTE_GUID)
+        attributes.extend(self.conf_LDAP_SYNC_USER_DN_RESOLVE.keys())
+        return attributes
+
+    def get_profile_field_name(self, name):
+        """Profile field of an LDAP attribute, after LDAP_SYNC_USER_CHANGE_FIELDCASE."""
+        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
+            return name.lower()
+        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
+            return name.upper()
+        return name
+
     def get_ldap_users(self):
         """Retrieve user data from LDAP server."""
         if (not self.conf_LDAP_SYNC_USER):
             return (None, None)
-        user_keys = set(self.conf_LDAP_SYNC_USER_ATTRIBUTES.keys())
-        user_keys.update(self.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES)
-        uri_users_server, users = self.ldap_search(self.conf_LDAP_SYNC_USER_FILTER, user_keys, self.conf_LDAP_SYNC_USER_INCREMENTAL, self.conf_LDAP_SYNC_USER_FILTER_INCREMENTAL)
-        logger.debug("Retrieved %d users from %s LDAP server" % (len(users), uri_users_server))
+        #Users are streamed, so the whole directory is never held in memory
+        search_info = {}
+        uri_users_server, users = self.ldap_search(self.conf_LDAP_SYNC_USER_FILTER, self.query.user_attributes, self.conf_LDAP_SYNC_USER_INCREMENTAL, self.conf_LDAP_SYNC_USER_FILTER_INCREMENTAL,
+                                                   self.query.user_entry_type, search_info, self.conf_LDAP_SYNC_USER_SHARDS)
+        #Removed users can only be detected when all of them were retrieved, or within the shard
+        self.users_full_search = (not search_info['incremental'])
+        self.users_shard = search_info['shard']
+        self.users_estimate = self.get_ldap_users_estimate(uri_users_server)
+        logger.debug("Retrieving users from %s LDAP server" % uri_users_server)
         return (uri_users_server, users)
 
+    def get_ldap_users_estimate(self, uri_users_server):
+        """
+        Number of users the search will return, for the progress ETA: counted with a
+        search without attributes (LDAP_SYNC_PROGRESS_COUNT), or taken from the
+        previous full sync. None if unknown.
+        """
+        if (self.conf_LDAP_SYNC_PROGRESS_COUNT):
+            count_type = LDAPEntryType([self.ATTRIBUTE_NO_ATTRIBUTES])
+            uri, entries = self.ldap_search(self.conf_LDAP_SYNC_USER_FILTER, count_type.attributes, self.conf_LDAP_SYNC_USER_INCREMENTAL, self.conf_LDAP_SYNC_USER_FILTER_INCREMENTAL, count_type,
+                                            shards=self.conf_LDAP_SYNC_USER_SHARDS)
+            return sum(1 for entry in entries)
+        if (self.users_full_search or (self.users_shard is not None)):
+            totals = ADldap_Sync.objects.filter(ldap_sync_uri=uri_users_server).values_list('last_full_sync_user_total', flat=True)
+            if (totals and totals[0]):
+                #Shards are name ranges, so their size is only roughly even
+                return (totals[0] if self.users_full_search else totals[0] // self.conf_LDAP_SYNC_USER_SHARDS)
+        return None
+
+    def get_ldap_users_by_name(self, usernames):
+        """
+        Retrieve some users from LDAP server, with a single search per chunk of
+        usernames: (&LDAP_SYNC_USER_FILTER(|(sAMAccountName=a)(sAMAccountName=b)...))
+        """
+        uri_users_server = None
+        ldap_users = []
+        for chunk in chunked(usernames, self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            users_filter = self.query.usernames_filter(chunk)
+            uri_users_server, users = self.ldap_search(users_filter, self.query.user_attributes, False, users_filter, self.query.user_entry_type)
+            ldap_users.extend(users)
+        logger.debug("Retrieved %d of %d users from %s LDAP server" % (len(ldap_users), len(usernames), uri_users_server))
+        return (uri_users_server, ldap_users)
+
+    def sync_ldap_usernames(self, usernames):
+        """
+        Synchronize only the given users, i.e. when they log in. Users missing
+        from LDAP are left untouched, they are only removed by a full sync.
+        Returns the usernames found in LDAP.
+        """
+        usernames = sorted(set(username.lower() for username in usernames))
+        if ((not self.conf_LDAP_SYNC_USER) or (not usernames)):
+            return set()
+        self.load_cached_group_graph()
+        self.users_full_search = False
+        #Requested users are always applied, even if unchanged in LDAP (i.e. to repair their Django row)
+        self.targeted_sync = True
+        #The progress published is the one of the whole syncs
+        self.conf_LDAP_SYNC_PROGRESS_CACHE = ''
+        uri_users_server, ldap_users = self.get_ldap_users_by_name(usernames)
+        found_usernames = set(entry.value(self.query.username_attribute, '').lower() for entry in ldap_users)
+        if ldap_users:
+            self.sync_ldap_users(ldap_users)
+        return found_usernames
+
+    def load_cached_group_graph(self):
+        """Groups aren't searched by the partial syncs, so only a cached graph can be used. Without one, the membership is searched per user."""
+        if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH):
+            self.group_graph = GroupGraph.load(self.conf_LDAP_SYNC_GROUP_GRAPH_FILE, self.query.membership_attributes[0])
+
+    def get_group_nesting(self):
+        """Digest of the group nesting, or None if it's unknown (the groups weren't all searched)."""
+        if (self.group_graph is not None):
+            return self.group_graph.digest()
+        return self.group_nesting
+
+    def open_snapshot(self):
+        """The LDAPSnapshot of the users sync, opened on first use. None without LDAP_SYNC_USER_SNAPSHOT_FILE, or on targeted syncs."""
+        if ((self.snapshot is None) and self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE and (not self.targeted_sync)):
+            nesting = (self.get_group_nesting() if self.conf_LDAP_SYNC_GROUP_MEMBERSHIP else '')
+            self.snapshot = LDAPSnapshot(self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE, self.get_snapshot_fingerprint(), nesting)
+        return self.snapshot
+
+    def get_snapshot_digest(self, attributes):
+        """(objectGUID, digest) of an entry for the snapshot, or (None, None)."""
+        if (self.snapshot is None):
+            return (None, None)
+        guid = attributes.get(self.ATTRIBUTE_GUID, [None])[0]
+        if (guid is None):
+            return (None, None)
+        return (guid, self.snapshot.digest(attributes))
+
+    def is_unchanged_ldap_user(self, guid, digest):
+        """If an entry didn't change since it was last applied. A forced full sync ignores the snapshot."""
+        return ((guid is not None) and (not self.force_full) and self.snapshot.is_unchanged(guid, digest))
+
     def sync_ldap_users(self, ldap_users):
         """Synchronize users with local user model."""
         model = get_user_model()
 
-        #Load total User starts
-        self.stats_user_total = len(ldap_users)
-
         list_profiles = []
         #Load extra profiles. This way we don't even need a callback. The same code is used to populate both auth_user and user_profile
         for list_profile in self.conf_LDAP_SYNC_USER_EXTRA_PROFILES:
@@ -312,267 +803,569 @@ class Command(BaseCommand):
         if not model._meta.get_field(self.conf_LDAP_SYNC_USERNAME_FIELD).unique:
             raise ImproperlyConfigured("Field '%s' must be unique" % self.conf_LDAP_SYNC_USERNAME_FIELD)
 
-        actualProgress = 0
+        snapshot = self.open_snapshot()
 
-        for cname, attributes in ldap_users:
+        actualProgress = 0
+        ldap_usernames = set()
+        disabled_usernames = []
+        pending_users = []
+        failed_usernames = set()
+        pending_digests = {}
+        disabled_digests = []  # (guid, digest) of the disabled users, recorded once they are deactivated
+
+        #A few users don't need a thread pool, their photos are written inline
+        if (self.conf_LDAP_SYNC_USER_PHOTO_WORKERS and list_profiles and (not self.targeted_sync)):
+            self.photo_uploader = PhotoUploader(self.conf_LDAP_SYNC_USER_PHOTO_WORKERS)
+            self.photo_counted_usernames = set()
+        if (self.conf_LDAP_SYNC_USER_DN_RESOLVE):
+            self.dn_resolver = DNResolver(self, [profile_model for name_profile, profile_model in list_profiles])
+
+        #Full syncs are checkpointed, so they can be resumed if interrupted
+        checkpoint = None
+        if (self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE and self.users_full_search):
+            checkpoint = SyncCheckpoint(self.conf_LDAP_SYNC_USER_CHECKPOINT_FILE, self.get_checkpoint_fingerprint())
+        last_checkpoint = time.time()
+        resumed_usernames = set()
+        if ((self.checkpoint_state is not None) and self.users_full_search):
+            state = self.checkpoint_state
+            for name, value in state['stats'].items():
+                setattr(self, name, value)
+            actualProgress = state['processed']
+            ldap_usernames = set(state['usernames'])
+            disabled_usernames = list(state['disabled_usernames'])
+            resumed_usernames = set(ldap_usernames)
+            logger.info("Resuming the sync after %d users. Last applied: %s" % (actualProgress, state['last_dn']))
+        #Users are streamed, so their total is only an estimate
+        progress = SyncProgress('users', self.users_estimate, self.conf_LDAP_SYNC_PROGRESS_CACHE)
+        progress.update(actualProgress)
+
+        for attributes in ldap_users:
             defaults = {}
             actualProgress += 1
-            if (self.conf_LDAP_SYNC_USER_SHOW_PROGRESS and ((100 * actualProgress // self.stats_user_total) > (100 * (actualProgress - 1) // self.stats_user_total))):
-                logger.info("AD User Sync: Processed %d/%d users (%d" % (actualProgress, self.stats_user_total, (100 * actualProgress) // self.stats_user_total) + "%)")
-            try:
-                for name, attribute in attributes.items():
-                    try:
-                        if ((name.lower() == 'thumbnailphoto') or (name.lower() == 'jpegphoto') or (name.lower() == 'thumbnaillogo')):
-                            defaults[self.conf_LDAP_SYNC_USER_ATTRIBUTES[name]] = attribute[0]
-                        else:
-                            defaults[self.conf_LDAP_SYNC_USER_ATTRIBUTES[name]] = attribute[0].decode('utf-8')
-                    except KeyError:
-                        pass
-                    except UnicodeDecodeError:
-                        raise ImproperlyConfigured('Error in attribute ' + name + ' ' + str(attribute))
-            except AttributeError:
-                # In some cases attributes is a list instead of a dict; skip these invalid users
-                continue
+            #Only the attributes mapped to the user model are decoded here
+            for name, field in self.conf_LDAP_SYNC_USER_ATTRIBUTES.items():
+                attribute = attributes.get(name)
+                if (not attribute):
+                    continue
+                try:
+                    if (name.lower() in self.PHOTO_ATTRIBUTES):
+                        defaults[field] = attribute[0]
+                    else:
+                        defaults[field] = self.decode_cache(attribute[:1])
+                except UnicodeDecodeError:
+                    raise ImproperlyConfigured('Error in attribute ' + name + ' ' + str(attribute))
 
             try:
                 username = defaults[self.conf_LDAP_SYNC_USERNAME_FIELD].lower()
             except KeyError:
                 logger.warning("User is missing a required attribute '%s'" % self.conf_LDAP_SYNC_USERNAME_FIELD)
+                self.journal_error('user', attributes.dn, '', "Missing the attribute of %s" % self.conf_LDAP_SYNC_USERNAME_FIELD)
                 continue
+            #Already applied before the interruption, and counted in the checkpoint
+            if (username in resumed_usernames):
+                actualProgress -= 1
+                continue
+            ldap_usernames.add(username)
+            if (self.dn_resolver is not None):
+                self.dn_resolver.add_user(attributes.dn, username)
 
             #Don't import users if they are in LDAP_SYNC_USER_EXEMPT_FROM_SYNC settings
             if (username in self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC):
                 logger.debug("Skip importing user %s, it appears in LDAP_SYNC_USER_EXEMPT_FROM_SYNC list" % username)
                 continue
 
-            kwargs = {
-                self.conf_LDAP_SYNC_USERNAME_FIELD + '__iexact': username,
-                'defaults': defaults,
-            }
+            #Skip entries that didn't change since they were last applied
+            guid, digest = self.get_snapshot_digest(attributes)
+            if (self.is_unchanged_ldap_user(guid, digest)):
+                self.add_stat('stats_user_unchanged', username)
+                continue
 
             ### Users Disable
-            #Check disable bit 
-            user_account_control = int(attributes[self.ATTRIBUTE_DISABLED][0].decode('utf-8'))
-            user_is_disabled = (user_account_control and ((user_account_control & self.FLAG_UF_ACCOUNT_DISABLE) == self.FLAG_UF_ACCOUNT_DISABLE))
-            if user_is_disabled:
-                try:
-                    #If disabled, we need to check if the user already exists on Django
-                    user = model.objects.get(**{self.conf_LDAP_SYNC_USERNAME_FIELD + '__iexact': username,})
-                    if (not user):
-                        #Ignore disabled users, we won't import it, only update it
-                        continue
-                except Exception as e:
-                    #Ignore disabled users, we won't import it, only update it
-                    continue
+            #Disabled users are never imported. The existing ones are handled in bulk after the LDAP pass
+            if (self.is_disabled_ldap_user(attributes)):
+                disabled_usernames.append(username)
+                if (guid is not None):
+                    disabled_digests.append((guid, digest))
+                continue
+
+            user_errors, membership_errors = self.stats_user_errors, self.stats_membership_errors
+            user, updated = self.sync_ldap_user(username, defaults, attributes)
+            if (user is not None):
+                pending_users.append((user, username, attributes, updated))
+            #Failed entries, even if only their membership did, are applied again on the next run
+            if ((self.stats_user_errors != user_errors) or (self.stats_membership_errors != membership_errors)):
+                failed_usernames.add(username)
+            if (guid is not None):
+                pending_digests[username] = (guid, digest)
+            #Profiles are synced in bulk, one chunk of users at a time
+            if (len(pending_users) >= self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                self.sync_ldap_users_chunk(pending_users, list_profiles, failed_usernames, pending_digests, snapshot)
+                pending_users, failed_usernames, pending_digests = [], set(), {}
+                progress.update(actualProgress)
+                if (self.conf_LDAP_SYNC_USER_SHOW_PROGRESS):
+                    logger.info("AD User Sync: %s" % progress)
+                if ((checkpoint is not None) and ((time.time() - last_checkpoint) >= self.conf_LDAP_SYNC_USER_CHECKPOINT_INTERVAL)):
+                    #Everything seen so far is applied, so the snapshot can be written too
+                    if (self.photo_uploader is not None):
+                        self.finish_photo_uploads(snapshot)
+                    if (self.dn_resolver is not None):
+                        self.dn_resolver.resolve()
+                    if (snapshot is not None):
+                        snapshot.commit()
+                    self.save_journal()
+                    checkpoint.save(self.get_checkpoint_state(attributes.dn, actualProgress, ldap_usernames, disabled_usernames))
+                    last_checkpoint = time.time()
+        self.sync_ldap_users_chunk(pending_users, list_profiles, failed_usernames, pending_digests, snapshot)
+        if (self.photo_uploader is not None):
+            self.finish_photo_uploads(snapshot)
+            self.photo_uploader.close()
+            self.photo_uploader = None
+        #Every user of the run exists now, so the DNs can be linked to them
+        if (self.dn_resolver is not None):
+            self.dn_resolver.resolve()
+            self.dn_resolver = None
+        #Users are streamed, so the total is only known at the end
+        self.stats_user_total = actualProgress
+        progress.finish(actualProgress)
+
+        if (disabled_usernames):
+            self.sync_disabled_ldap_users(disabled_usernames)
+        #Only now, so a checkpointed run that is interrupted deactivates them on the next one
+        for guid, digest in disabled_digests:
+            snapshot.update(guid, digest)
+
+        if (snapshot is not None):
+            snapshot.commit()
+            snapshot.close()
+            self.snapshot = None
+            logger.debug("%d users unchanged since the last snapshot" % self.stats_user_unchanged)
+
+        self.save_journal()
+        if (self.users_full_search):
+            self.sync_removed_ldap_users(ldap_usernames)
+        elif (self.users_shard is not None):
+            self.sync_removed_ldap_users(ldap_usernames, self.users_shard)
+        if (checkpoint is not None):
+            checkpoint.delete()
+        self.checkpoint_state = None
+        logger.info("Users are synchronized")
+
+    def is_applied_ldap_user(self, attributes):
+        """If sync_ldap_users applies an entry: it isn't exempt, unchanged since the snapshot or disabled."""
+        username = attributes.value(self.query.username_attribute)
+        if ((username is None) or (username.lower() in self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC)):
+            return False
+        if (self.is_unchanged_ldap_user(*self.get_snapshot_digest(attributes))):
+            return False
+        return (not self.is_disabled_ldap_user(attributes))
+
+    def is_disabled_ldap_user(self, attributes):
+        """Check the disable bit of userAccountControl."""
+        user_account_control = int(attributes.get(self.ATTRIBUTE_DISABLED, [b'0'])[0].decode('utf-8'))
+        return ((user_account_control & self.FLAG_UF_ACCOUNT_DISABLE) == self.FLAG_UF_ACCOUNT_DISABLE)
+
+    def sync_disabled_ldap_users(self, disabled_usernames):
+        """
+        Run LDAP_SYNC_REMOVED_USER_CALLBACKS on the Django users that are disabled
+        in LDAP, one chunk at a time. Callbacks with a ``batch`` attribute get a
+        queryset for the whole chunk; the others are called once per user.
+        """
+        if (not self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS):
+            return
+        model = get_user_model()
+        callbacks = [(path, import_string(path)) for path in self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS]
+        #LDAP usernames are lowercased, Django ones keep the LDAP case
+        lower_username = 'lower_' + self.conf_LDAP_SYNC_USERNAME_FIELD
+        for usernames in chunked(disabled_usernames, self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            disabled_users = list(model.objects.annotate(**{lower_username: Lower(self.conf_LDAP_SYNC_USERNAME_FIELD)})
+                                  .filter(**{lower_username + '__in': usernames}).values_list('pk', lower_username))
+            if (not disabled_users):
+                continue
+            user_pks = [pk for pk, username in disabled_users]
+            for pk, username in disabled_users:
+                self.add_stat('stats_user_deleted', username)
+            for path, callback in callbacks:
+                logger.debug("Calling %s for %d disabled users" % (path, len(user_pks)))
+                batch_callback = getattr(callback, 'batch', None)
+                if (batch_callback is not None):
+                    batch_callback(model.objects.filter(pk__in=user_pks))
                 else:
-                    #If the user already exists on Django we'll run the callbacks
-                    if (self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS):
-                        self.stats_user_deleted += 1
-                    for path in self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS:
-                        logger.debug("Calling %s for user %s" % (path, username))
-                        callback = import_string(path)
+                    for user in model.objects.filter(pk__in=user_pks):
                         callback(user)
-            ### User creation and sinchronization
-            updated = False
-            try:
-                if user_is_disabled:
-                    created = False
-                    #reload it because it may be deleted
-                    user = model.objects.get(**{self.conf_LDAP_SYNC_USERNAME_FIELD + '__iexact': username,})
-                else:
-                    user, created = model.objects.get_or_create(**kwargs)
-            except (ObjectDoesNotExist) as e:
-                if (user_is_disabled):
+
+    def sync_removed_ldap_users(self, ldap_usernames, shard=None):
+        """
+        Apply LDAP_SYNC_USER_REMOVAL_ACTION to the Django users that a full LDAP
+        search didn't return. With a shard, only the Django users in the shard are checked.
+        Superusers are local accounts (i.e. from createsuperuser), so they are never removed.
+        """
+        if (self.conf_LDAP_SYNC_USER_REMOVAL_ACTION == 'KEEP'):
+            return
+        if (not ldap_usernames):
+            logger.warning("Skipping user removal: the LDAP search didn't return any user")
+            return
+        model = get_user_model()
+        username_field = self.conf_LDAP_SYNC_USERNAME_FIELD
+        exempt_usernames = set(exempt.lower() for exempt in self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC)
+
+        #Lowercased username -> Django username, as LDAP usernames are compared case insensitive
+        django_usernames = {}
+        users = model.objects.all()
+        if ('is_superuser' in [field.name for field in model._meta.concrete_fields]):
+            users = users.filter(is_superuser=False)
+        for django_username in users.values_list(username_field, flat=True):
+            if django_username:
+                if ((shard is not None) and (not self.query.in_shard(django_username.lower(), shard, self.conf_LDAP_SYNC_USER_SHARDS))):
                     continue
-                else:
-                    raise e
-            except (IntegrityError, DataError) as e:
-                logger.error("Error creating user %s: %s" % (username, e))
-                self.stats_user_errors += 1
+                django_usernames[django_username.lower()] = django_username
+        removed_usernames = [django_usernames[name] for name in (set(django_usernames) - ldap_usernames - exempt_usernames)]
+        if (not removed_usernames):
+            return
+
+        if (len(removed_usernames) > self.conf_LDAP_SYNC_USER_REMOVAL_THRESHOLD * len(django_usernames)):
+            logger.error("Aborting user removal: %d of %d Django users are not in LDAP, over the LDAP_SYNC_USER_REMOVAL_THRESHOLD of %s" \
+                         % (len(removed_usernames), len(django_usernames), self.conf_LDAP_SYNC_USER_REMOVAL_THRESHOLD))
+            return
+
+        for usernames in chunked(removed_usernames, self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            queryset = users.filter(**{username_field + '__in': usernames})
+            if (self.conf_LDAP_SYNC_USER_REMOVAL_ACTION == 'DEACTIVATE'):
+                queryset = queryset.filter(is_active=True)
+            #Counted per user, so the statistics of the checkpoints and of each source stay consistent
+            removed = list(queryset.values_list(username_field, flat=True))
+            if (self.conf_LDAP_SYNC_USER_REMOVAL_ACTION == 'DEACTIVATE'):
+                queryset.update(is_active=False)
             else:
-                user_updated = False
-                if created:
-                    logger.debug("Created user %s" % username)
-                    self.stats_user_added += 1
-                    user.set_unusable_password()
-                else:
-                    for name, attr in defaults.items():
-                        current_attr = getattr(user, name, None)
-                        if current_attr != attr:
-                            setattr(user, name, attr)
-                            if (not user_updated):
-                                user_updated = True
-                    if user_updated:
-                        logger.debug("Updated user %s" % username)
-                        updated = True
-
-                for path in self.conf_LDAP_SYNC_USER_CALLBACKS:
-                    callback = import_string(path)
-                    callback(user, attributes, created, user_updated)
+                queryset.delete()
+            for username in removed:
+                self.add_stat('stats_user_deleted', username.lower())
+        logger.info("Removed users: %d Django users not found in LDAP (%s)" % (len(removed_usernames), self.conf_LDAP_SYNC_USER_REMOVAL_ACTION))
+
+    def get_checkpoint_fingerprint(self):
+        """Settings that change which users are synced and how. A checkpoint is only resumed with the same ones."""
+        return repr((self.get_snapshot_fingerprint(), self.conf_LDAP_SYNC_USER_SEARCH, self.conf_LDAP_SYNC_USER_FILTER, self.conf_LDAP_SYNC_USER_EXEMPT_FROM_SYNC))
+
+    def get_checkpoint_state(self, last_dn, processed, ldap_usernames, disabled_usernames):
+        return {
+            'whenchanged': (self.whenchanged - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds(),
+            'last_dn': last_dn,
+            'processed': processed,
+            'stats': dict((name, getattr(self, name)) for name in self.CHECKPOINT_STATS),
+            'usernames': sorted(ldap_usernames),
+            'disabled_usernames': disabled_usernames,
+        }
+
+    def get_snapshot_fingerprint(self):
+        """Settings that change how an entry is applied. Changing any of them invalidates the snapshot."""
+        return repr((sorted(self.conf_LDAP_SYNC_USER_ATTRIBUTES.items()), self.conf_LDAP_SYNC_USER_EXTRA_PROFILES, self.conf_LDAP_SYNC_USER_CALLBACKS,
+                     self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE, self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR, self.conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME,
+                     self.conf_LDAP_SYNC_REMOVED_USER_CALLBACKS, self.conf_LDAP_SYNC_GROUP_MEMBERSHIP, self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT,
+                     sorted(self.conf_LDAP_SYNC_USER_DN_RESOLVE.items()), self.conf_LDAP_SYNC_GROUP_ALLOW, self.conf_LDAP_SYNC_GROUP_DENY))
+
+    def sync_ldap_user(self, username, defaults, attributes):
+        """
+        Create or update a single LDAP user and its group membership.
+        Returns the user (None if it couldn't be created) and whether it was updated.
+        """
+        model = get_user_model()
+        kwargs = {
+            self.conf_LDAP_SYNC_USERNAME_FIELD + '__iexact': username,
+            'defaults': defaults,
+        }
 
-                try:
-                    if (created or user_updated):
-                        user.save()
-                except Exception as e:
-                    logger.error("Error saving user %s: %s" % (username, e))
-                    self.stats_user_errors += 1
-                ### LDAP Sync Membership
-                if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP):
-                    membership_uri, ldap_membership = self.get_ldap_user_membership(attributes[self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD][0].decode('utf-8'))
-                    if ldap_membership:
-                        self.sync_ldap_user_membership(user, ldap_membership)
-            #Profile creation and update.
+        ### User creation and sinchronization
+        try:
+            user, created = model.objects.get_or_create(**kwargs)
+        except (IntegrityError, DataError) as e:
+            logger.error("Error creating user %s: %s" % (username, e))
+            self.add_stat('stats_user_errors', username)
+            self.journal_error('user', attributes.dn, username, e)
+            return (None, False)
+
+        user_updated = False
+        changed_fields = []
+        if created:
+            logger.debug("Created user %s" % username)
+            self.add_stat('stats_user_added', username)
+            user.set_unusable_password()
+            changed_fields.append('password')
+        else:
+            for name, attr in defaults.items():
+                current_attr = getattr(user, name, None)
+                if current_attr != attr:
+                    setattr(user, name, attr)
+                    changed_fields.append(name)
+            user_updated = bool(changed_fields)
+            if user_updated:
+                logger.debug("Updated user %s" % username)
+
+        if (self.conf_LDAP_SYNC_USER_CALLBACKS):
+            #The fields changed by the callbacks are saved too
+            fields = [field for field in model._meta.concrete_fields if field.name not in changed_fields]
+            values = [getattr(user, field.attname) for field in fields]
+            for path in self.conf_LDAP_SYNC_USER_CALLBACKS:
+                callback = import_string(path)
+                callback(user, attributes, created, user_updated)
+            changed_fields += [field.name for field, value in zip(fields, values) if getattr(user, field.attname) != value]
+
+        try:
+            if (changed_fields):
+                self.save_changed_fields(user, changed_fields)
+        except Exception as e:
+            logger.error("Error saving user %s: %s" % (username, e))
+            self.add_stat('stats_user_errors', username)
+            self.journal_error('user', attributes.dn, username, e)
+        ### LDAP Sync Membership
+        if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP):
+            source = self.entry_sources.get(getattr(attributes, 'entry_type', None), self)
+            if (source.group_graph is not None):
+                ldap_membership = source.group_graph.get_user_groups(attributes.get(self.ATTRIBUTE_MEMBEROF, []))
+            else:
+                membership_uri, ldap_membership = source.get_ldap_user_membership(attributes[self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_DN_FIELD][0].decode('utf-8'))
+            #An empty list is synced too: the user doesn't belong to any group anymore
+            if (ldap_membership is not None):
+                membership_errors = self.stats_membership_errors
+                self.sync_ldap_user_membership(user, ldap_membership)
+                if (self.stats_membership_errors != membership_errors):
+                    self.journal_error('membership', attributes.dn, username, "%d groups couldn't be synced" % (self.stats_membership_errors - membership_errors))
+            else:
+                self.add_stat('stats_membership_errors', username)
+                self.journal_error('membership', attributes.dn, username, "The group membership couldn't be searched")
+        return (user, user_updated)
+
+    def save_changed_fields(self, instance, fields):
+        """
+        Write only the changed fields of an instance. Without LDAP_SYNC_SEND_SIGNALS
+        it's a queryset update(), so no pre_save/post_save signals are sent.
+        """
+        if (self.conf_LDAP_SYNC_SEND_SIGNALS):
+            instance.save(update_fields=fields)
+        else:
+            values = dict((name, getattr(instance, name)) for name in fields)
+            type(instance)._default_manager.filter(pk=instance.pk).update(**values)
+
+    def sync_ldap_users_chunk(self, pending_users, list_profiles, failed_usernames, pending_digests, snapshot):
+        """Sync the profiles of a chunk of users, then account their statistics and snapshot entries."""
+        updated_usernames = set()
+        if (pending_users):
             for name_profile, profile_model in list_profiles:
-                try:
-                    profile, created = profile_model.objects.get_or_create(user=user)  # ,  **kwargs )
-                except (IntegrityError, DataError) as e:
-                    logger.error("Error creating profile %s for user %s: %s" % (name_profile, username, e))
-                    self.stats_user_errors += 1
+                updated_usernames.update(self.sync_ldap_user_profiles(pending_users, name_profile, profile_model, failed_usernames))
+        #If either user record or any profile record is changed, we'll mark it as updated.
+        for user, username, attributes, updated in pending_users:
+            #Applied again: its previous errors are cleared, except the ones of this run
+            self.journal_seen('user', attributes.dn)
+            if (updated or (username in updated_usernames)):
+                self.add_stat('stats_user_updated', username)
+                if (self.photo_uploader is not None):
+                    self.photo_counted_usernames.add(username)
+            if ((self.dn_resolver is not None) and (username not in failed_usernames)):
+                self.dn_resolver.add_profiles(user.pk, attributes)
+            attributes.discard_binary()
+        if (snapshot is not None):
+            for username, (guid, digest) in pending_digests.items():
+                if (username in failed_usernames):
+                    snapshot.discard(guid)
                 else:
-                    profile_updated = False
-                    if (created):
-                        logger.debug("Created profile '%s' for user '%s'" % (name_profile, username))
-                        #profile.save()
-                    for unchanged_name, attr in attributes.items():
-                        name = unchanged_name
-                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                            name = unchanged_name.lower()
-                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                            name = unchanged_name.upper()
-
-                        try:
-                            if ((name.lower() != 'thumbnailphoto') and (name.lower() != 'jpegphoto') and (name.lower() != 'thumbnaillogo') ):
-                                current_attr = getattr(profile, name)
-                                new_value = ''
-                                if (isinstance(attr, list)):
-                                    for val in attr:
-                                        new_value += val.decode("utf8") + self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR
-                                    if (new_value != ""):
-                                        new_value = new_value[:-len(self.conf_LDAP_SYNC_MULTIVALUE_SEPARATOR)]
-                                else:
-                                    new_value = attr
-                                if current_attr != new_value:
-                                    setattr(profile, name, new_value)
-                                    #logger.debug("Updated profile %s: Attribute %s from '%s' to '%s' - '%s'" % (username,name, current_attr, new_value, attr))
-                                    profile_updated = True
-                            else:
-                                if (isinstance(attr, list)):
-                                    newthumbPhoto = attr[0]
-                                else:
-                                    newthumbPhoto = attr
-                                actualPhoto = None
-                                try:
-                                    if (name.lower() == 'thumbnailphoto'):
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            actualPhoto = profile.thumbnailPhoto.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            actualPhoto = profile.thumbnailphoto.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            actualPhoto = profile.THUMBNAILPHOTO.read()
-                                    elif (name.lower() == 'thumbnaillogo'):
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            actualPhoto = profile.thumbnailLogo.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            actualPhoto = profile.thumbnaillogo.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            actualPhoto = profile.THUMBNAILLOGO.read()                                            
-                                    else:
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            actualPhoto = profile.jpegPhoto.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            actualPhoto = profile.jpegphoto.read()
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            actualPhoto = profile.JPEGPHOTO.read()
-                                except Exception as e:
-                                    pass
-                                if (actualPhoto != newthumbPhoto):
-                                    #Saving thumbnailphoto
-                                    #logger.debug("Photo in "+username+" are different... ")
-                                    photo_name = self.conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME
-                                    #we don't format because I don't know if username it's being used at all
-                                    photo_name = photo_name.replace('{username}', username)
-                                    photo_name = photo_name.replace('{uuid4}', str(uuid.uuid4()))
-                                    photo_name = datetime.now().strftime(photo_name)
-                                    if (name.lower() == 'thumbnailphoto'):
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            if (actualPhoto):
-                                                profile.thumbnailPhoto.delete()
-                                            profile.thumbnailPhoto.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            if (actualPhoto):
-                                                profile.thumbnailphoto.delete()
-                                            profile.thumbnailphoto.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            if (actualPhoto):
-                                                profile.THUMBNAILPHOTO.delete()
-                                            profile.THUMBNAILPHOTO.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                    elif (name.lower() == 'thumbnaillogo'):
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            if (actualPhoto):
-                                                profile.thumbnailLogo.delete()
-                                            profile.thumbnailLogo.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            if (actualPhoto):
-                                                profile.thumbnaillogo.delete()
-                                            profile.thumbnaillogo.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            if (actualPhoto):
-                                                profile.THUMBNAILLOGO.delete()
-                                            profile.THUMBNAILLOGO.save(name=photo_name, content=ContentFile(newthumbPhoto))                                            
-                                    else:
-                                        if (not self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE):
-                                            if (actualPhoto):
-                                                profile.jpegPhoto.delete()
-                                            profile.jpegPhoto.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "lower"):
-                                            if (actualPhoto):
-                                                profile.jpegphoto.delete()
-                                            profile.jpegphoto.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                        if (self.conf_LDAP_SYNC_USER_CHANGE_FIELDCASE == "upper"):
-                                            if (actualPhoto):
-                                                profile.JPEGPHOTO.delete()
-                                            profile.JPEGPHOTO.save(name=photo_name, content=ContentFile(newthumbPhoto))
-                                    profile_updated = True
-                                else:
-                                    pass
-                                    #logger.debug("Photo "+username+" are equal")
-                        except AttributeError:
-                            pass
-                            #logger.debug("Ignore Attribute %s on profile '%s'" % (name, name_profile))
-                    if profile_updated:
-                        logger.debug("Updated profile %s on user %s" % (name_profile, username))
-                        updated = True
-                    if (created or profile_updated):
-                        try:
+                    snapshot.update(guid, digest)
+
+    def finish_photo_uploads(self, snapshot):
+        """Attach the stored photos to their profiles, and account them."""
+        updated_usernames, failed = self.photo_uploader.finish(self.conf_LDAP_SYNC_BULK_BATCH_SIZE)
+        for username in (updated_usernames - self.photo_counted_usernames):
+            self.add_stat('stats_user_updated', username)
+        self.photo_counted_usernames = set()
+        for username, guid, dn, error in failed:
+            self.add_stat('stats_user_errors', username)
+            self.journal_error('photo', dn, username, error)
+            if ((snapshot is not None) and (guid is not None)):
+                snapshot.discard(guid)
+
+    def sync_ldap_user_profiles(self, pending_users, name_profile, profile_model, failed_usernames):
+        """
+        Create or update one profile model for a chunk of users. Existing profiles
+        are fetched with a single query, and the changes are written with
+        bulk_create/bulk_update. Returns the usernames whose profile changed.
+        """
+        updated_usernames = set()
+        profile_fields = set(field.name for field in profile_model._meta.concrete_fields)
+        users = dict((user.pk, (user, username, attributes)) for user, username, attributes, updated in pending_users)
+        profile_dns = dict((username, attributes.dn) for user, username, attributes, updated in pending_users)
+        profiles = dict((profile.user_id, profile) for profile in profile_model.objects.filter(user__in=list(users.keys())))
+
+        new_profiles = []
+        changed_profiles = {}  # changed fields -> [(username, profile), ...]
+        for user_pk, (user, username, attributes) in users.items():
+            profile = profiles.get(user_pk)
+            created = (profile is None)
+            if (created):
+                profile = profile_model(user=user)
+            profile_changes = self.get_ldap_user_profile_changes(profile, profile_fields, attributes, username)
+            if (profile_changes):
+                logger.debug("Updated profile %s on user %s" % (name_profile, username))
+                updated_usernames.add(username)
+            if (created):
+                logger.debug("Created profile '%s' for user '%s'" % (name_profile, username))
+                new_profiles.append((username, profile))
+            elif (profile_changes):
+                #Profiles are grouped by their changed fields, so only those columns are written
+                changed_profiles.setdefault(frozenset(profile_changes), []).append((username, profile))
+
+        if (new_profiles):
+            try:
+                with transaction.atomic():
+                    profile_model.objects.bulk_create([profile for username, profile in new_profiles], batch_size=self.conf_LDAP_SYNC_BULK_BATCH_SIZE)
+            except (IntegrityError, DataError) as e:
+                #Find out which profiles are failing
+                for username, profile in new_profiles:
+                    try:
+                        with transaction.atomic():
                             profile.save()
-                        except Exception as e:
-                            logger.error("Error saving profile %s for user %s: %s" % (name_profile, username, e))
-                            self.stats_user_errors += 1
-                    #profile.save()
-                    #If either user record or any profile record is changed, we'll mark it as updated.
-            if (updated):
-                self.stats_user_updated += 1
+                    except (IntegrityError, DataError) as e:
+                        logger.error("Error creating profile %s for user %s: %s" % (name_profile, username, e))
+                        self.add_stat('stats_user_errors', username)
+                        failed_usernames.add(username)
+                        self.journal_error('profile', profile_dns[username], username, e)
+        for changed_fields, profiles in changed_profiles.items():
+            try:
+                with transaction.atomic():
+                    profile_model.objects.bulk_update([profile for username, profile in profiles], list(changed_fields), batch_size=self.conf_LDAP_SYNC_BULK_BATCH_SIZE)
+            except Exception as e:
+                for username, profile in profiles:
+                    try:
+                        with transaction.atomic():
+                            self.save_changed_fields(profile, list(changed_fields))
+                    except Exception as e:
+                        logger.error("Error saving profile %s for user %s: %s" % (name_profile, username, e))
+                        self.add_stat('stats_user_errors', username)
+                        failed_usernames.add(username)
+                        self.journal_error('profile', profile_dns[username], username, e)
+        return updated_usernames
+
+    def get_ldap_user_profile_changes(self, profile, profile_fields, attributes, username):
+        """Copy the LDAP attributes to a profile instance. Returns the names of the changed fields."""
+        changed_fields = []
+        for unchanged_name, attr in attributes.items():
+            name = self.get_profile_field_name(unchanged_name)
+            if (name not in profile_fields):
+                #logger.debug("Ignore Attribute %s on profile" % name)
+                continue
+            if (name in self.conf_LDAP_SYNC_USER_DN_RESOLVE.values()):
+                #Written by the DNResolver
+                continue
 
-        logger.info("Users are synchronized")
+            if (name.lower() not in self.PHOTO_ATTRIBUTES):
+                current_attr = getattr(profile, name)
+                if (isinstance(attr, list)):
+                    new_value = self.decode_cache(attr)
+                else:
+                    new_value = attr
+                if current_attr != new_value:
+                    setattr(profile, name, new_value)
+                    #logger.debug("Updated profile %s: Attribute %s from '%s' to '%s' - '%s'" % (username,name, current_attr, new_value, attr))
+                    changed_fields.append(name)
+            else:
+                if (isinstance(attr, list)):
+                    newthumbPhoto = attr[0]
+                else:
+                    newthumbPhoto = attr
+                if (self.photo_uploader is not None):
+                    #Compared and written by the uploader threads, then attached in bulk
+                    self.photo_uploader.submit(profile, name, newthumbPhoto, self.get_photo_name(username), username, attributes.get(self.ATTRIBUTE_GUID, [None])[0], attributes.dn)
+                    continue
+                photo = getattr(profile, name)
+                actualPhoto = None
+                try:
+                    actualPhoto = photo.read()
+                except Exception as e:
+                    pass
+                if (actualPhoto != newthumbPhoto):
+                    #Saving thumbnailphoto
+                    photo_name = self.get_photo_name(username)
+                    #The profile itself is written in bulk afterwards
+                    if (actualPhoto):
+                        photo.delete(save=False)
+                    photo.save(name=photo_name, content=ContentFile(newthumbPhoto), save=False)
+                    changed_fields.append(name)
+                    #An ImageField sets its dimension fields on save, so they're written too
+                    changed_fields.extend(dimension for dimension in (getattr(photo.field, 'width_field', None), getattr(photo.field, 'height_field', None)) if dimension)
+        return changed_fields
+
+    def get_photo_name(self, username):
+        photo_name = self.conf_LDAP_SYNC_USER_THUMBNAILPHOTO_NAME
+        #we don't format because I don't know if username it's being used at all
+        photo_name = photo_name.replace('{username}', username)
+        photo_name = photo_name.replace('{uuid4}', str(uuid.uuid4()))
+        return datetime.now().strftime(photo_name)
 
     def get_ldap_groups(self):
         """Retrieve groups from LDAP server."""
         if (not self.conf_LDAP_SYNC_GROUP):
             return (None, None)
-        uri_groups_server, groups = self.ldap_search(self.conf_LDAP_SYNC_GROUP_FILTER, self.conf_LDAP_SYNC_GROUP_ATTRIBUTES.keys(), self.conf_LDAP_SYNC_GROUP_INCREMENTAL, self.conf_LDAP_SYNC_GROUP_FILTER_INCREMENTAL)
+        search_info = {}
+        group_filter, group_filter_incremental = self.conf_LDAP_SYNC_GROUP_FILTER, self.conf_LDAP_SYNC_GROUP_FILTER_INCREMENTAL
+        #The group graph and the snapshot need every group for the nesting, so it's filtered in memory then
+        if (not (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH or self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE))):
+            group_filter, group_filter_incremental = self.query.group_filter(group_filter), self.query.group_filter(group_filter_incremental)
+        uri_groups_server, groups = self.ldap_search(group_filter, self.query.group_attributes, self.conf_LDAP_SYNC_GROUP_INCREMENTAL, group_filter_incremental,
+                                                     search_info=search_info)
         logger.debug("Retrieved %d groups from %s LDAP server" % (len(groups), uri_groups_server))
+        if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH):
+            self.load_group_graph(groups, search_info['incremental'])
+        elif (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP and self.conf_LDAP_SYNC_USER_SNAPSHOT_FILE and (not search_info['incremental'])):
+            #Nesting a group doesn't change the entries of its users, see LDAPSnapshot
+            nesting = GroupGraph(self.query.membership_attributes[0])
+            nesting.update(groups, self.ATTRIBUTE_MEMBEROF, True)
+            self.group_nesting = nesting.digest()
         return (uri_groups_server, groups)
 
+    def load_group_graph(self, ldap_groups, incremental):
+        """
+        Build the group nesting graph from the group search. An incremental search
+        only updates the changed groups of the cached graph, and their children.
+        """
+        name_attribute = self.query.membership_attributes[0]
+        graph = None
+        if (incremental):
+            graph = GroupGraph.load(self.conf_LDAP_SYNC_GROUP_GRAPH_FILE, name_attribute)
+            if (graph is None):
+                #Nothing cached to update, so the graph needs every group
+                logger.debug("No cached group graph, retrieving all the groups")
+                uri, ldap_groups = self.ldap_search(self.conf_LDAP_SYNC_GROUP_FILTER, self.query.group_attributes, False, self.conf_LDAP_SYNC_GROUP_FILTER)
+                incremental = False
+        if (graph is None):
+            graph = GroupGraph(name_attribute)
+        graph.update(ldap_groups, self.ATTRIBUTE_MEMBEROF, (not incremental))
+        if (incremental):
+            #Groups nested in the changed ones, with a search per chunk. Their memberOf isn't range limited like the member of big groups
+            changed_dns = [dn for dn, attributes in ldap_groups if ((dn is not None) and isinstance(attributes, dict))]
+            ldap_children = []
+            for chunk in chunked(changed_dns, self.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                children_filter = self.query.children_filter(chunk)
+                uri, children = self.ldap_search(children_filter, self.query.group_attributes, False, children_filter)
+                ldap_children.extend(children)
+            graph.update_children(changed_dns, ldap_children, self.ATTRIBUTE_MEMBEROF)
+            #Deleted groups aren't returned by the incremental search, only the DNs of all of them tell
+            uri, existing = self.ldap_search(self.conf_LDAP_SYNC_GROUP_FILTER, [self.ATTRIBUTE_NO_ATTRIBUTES], False, self.conf_LDAP_SYNC_GROUP_FILTER)
+            graph.prune([dn for dn, attributes in existing if dn is not None])
+        if (self.conf_LDAP_SYNC_GROUP_GRAPH_FILE):
+            graph.save(self.conf_LDAP_SYNC_GROUP_GRAPH_FILE)
+        self.group_graph = graph
+
     def sync_ldap_groups(self, ldap_groups):
         """Synchronize LDAP groups with local group model."""
         groupname_field = 'name'
         self.stats_group_total = len(ldap_groups)
+        progress = SyncProgress('groups', len(ldap_groups), self.conf_LDAP_SYNC_PROGRESS_CACHE)
 
-        for cname, ldap_attributes in ldap_groups:
+        for position, (cname, ldap_attributes) in enumerate(ldap_groups):
+            if ((position % self.conf_LDAP_SYNC_BULK_BATCH_SIZE) == 0):
+                progress.update(position)
             defaults = {}
             try:
                 for name, attribute in ldap_attributes.items():
-                    defaults[self.conf_LDAP_SYNC_GROUP_ATTRIBUTES[name]] = attribute[0].decode('utf-8')
+                    #memberOf is also requested for the group graph
+                    if (name in self.conf_LDAP_SYNC_GROUP_ATTRIBUTES):
+                        defaults[self.conf_LDAP_SYNC_GROUP_ATTRIBUTES[name]] = attribute[0].decode('utf-8')
             except AttributeError:
                 # In some cases attrs is a list instead of a dict; skip these invalid groups
                 continue
@@ -581,7 +1374,10 @@ class Command(BaseCommand):
                 groupname = defaults[groupname_field]
             except KeyError:
                 logger.warning("Group is missing a required attribute '%s'" % groupname_field)
-                self.stats_group_errors += 1
+                self.add_stat('stats_group_errors', cname)
+                self.journal_error('group', cname, '', "Missing the attribute of %s" % groupname_field)
+                continue
+            if (not self.query.is_allowed_group(groupname)):
                 continue
 
             kwargs = {
@@ -592,40 +1388,57 @@ class Command(BaseCommand):
                 group, created = Group.objects.get_or_create(**kwargs)
             except (IntegrityError, DataError) as e:
                 logger.error("Error creating group %s: %s" % (groupname, e))
-                self.stats_group_errors += 1
+                self.add_stat('stats_group_errors', cname)
+                self.journal_error('group', cname, groupname, e)
             else:
+                self.journal_seen('group', cname)
                 if created:
-                    self.stats_group_added += 1
+                    self.add_stat('stats_group_added', cname)
                     logger.debug("Created group %s" % groupname)
+                    if (self.group_pks is not None):
+                        self.group_pks[groupname.lower()] = group.pk
 
+        progress.finish(len(ldap_groups))
+        self.save_journal()
         logger.info("Groups are synchronized")
 
     def get_ldap_user_membership(self, user_dn):
         """Retrieve user membership from LDAP server."""
-        #Escape parenthesis in DN
-        membership_filter = self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_FILTER.replace('{distinguishedName}', user_dn.replace('(', "\(").replace(')', "\)"))
+        if (self.membership_cache is not None) and (user_dn in self.membership_cache):
+            return self.membership_cache.pop(user_dn)
+        membership_filter = self.query.membership_filter(user_dn)
         try:
-            uri, groups = self.ldap_search(membership_filter, self.conf_LDAP_SYNC_GROUP_ATTRIBUTES.keys(), False, membership_filter)
+            uri, groups = self.ldap_search(membership_filter, self.query.membership_attributes, False, membership_filter)
         except Exception as e:
-            logger.error("Error reading membership: Filter %s, Keys %s" % (membership_filter, str(self.conf_LDAP_SYNC_GROUP_ATTRIBUTES.keys())))
-            return None
+            logger.error("Error reading membership: Filter %s, Keys %s: %s" % (membership_filter, self.query.membership_attributes, e))
+            return (None, None)
         #logger.debug("AD Membership: Retrieved %d groups for user '%s'" % (len(groups), user_dn))
         return (uri, groups)
 
+    def get_group_pks(self):
+        """Lowercased name -> pk of the Django groups. They are fetched once, so LDAP groups missing in Django cost no query."""
+        if (self.group_pks is None):
+            self.group_pks = dict((name.lower(), pk) for pk, name in Group.objects.values_list('pk', 'name'))
+        return self.group_pks
+
     def sync_ldap_user_membership(self, user, ldap_groups):
         """Synchronize LDAP membership to Django membership"""
         groupname_field = 'name'
-        actualGroups = user.groups.values_list('name', flat=True)
+        group_pks = self.get_group_pks()
+        actualGroups = dict((name.lower(), pk) for pk, name in user.groups.values_list('pk', 'name'))
         user_Membership_total = len(ldap_groups)
         user_Membership_added = 0
         user_Membership_deleted = 0
         user_Membership_errors = 0
 
-        ldap_groups += self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT
+        #The default groups are always added, whatever LDAP_SYNC_GROUP_ALLOW and LDAP_SYNC_GROUP_DENY say
+        ldap_group_count = len(ldap_groups)
+        ldap_groups = list(ldap_groups) + list(self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_ADD_DEFAULT)
 
-        ldap_name_groups = []
+        ldap_name_groups = set()
+        added_pks = []
 
-        for cname, ldap_attributes in ldap_groups:
+        for position, (cname, ldap_attributes) in enumerate(ldap_groups):
             defaults = {}
             try:
                 for name, attribute in ldap_attributes.items():
@@ -636,61 +1449,62 @@ class Command(BaseCommand):
 
             try:
                 groupname = defaults[groupname_field]
-                ldap_name_groups.append(groupname)
             except KeyError:
                 logger.warning("Group is missing a required attribute '%s'" % groupname_field)
                 user_Membership_errors += 1
                 continue
-            if (groupname not in actualGroups):
-                kwargs = {
-                    groupname_field + '__iexact': groupname,
-                    'defaults': defaults,
-                }
-
-                #Adding Group Membership
-                try:
-                    if (self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS):
+            if ((position < ldap_group_count) and (not self.query.is_allowed_group(groupname))):
+                continue
+            ldap_name_groups.add(groupname.lower())
+            if (groupname.lower() not in actualGroups):
+                group_pk = group_pks.get(groupname.lower())
+                if (group_pk is None):
+                    if (not self.conf_LDAP_SYNC_GROUP_MEMBERSHIP_CREATE_IF_NOT_EXISTS):
+                        #Doesn't exist and not autocreate groups
+                        continue
+                    kwargs = {
+                        groupname_field + '__iexact': groupname,
+                        'defaults': defaults,
+                    }
+                    try:
                         group, created = Group.objects.get_or_create(**kwargs)
-                    else:
-                        group = Group.objects.get(name=groupname)
-                        created = False
-                except (ObjectDoesNotExist):
-                    #Doesn't exist and not autocreate groups, we pass the error
-                    continue
-                except (IntegrityError, DataError) as e:
-                    logger.error("Error creating group %s: %s" % (groupname, e))
-                    user_Membership_errors += 1
-                else:
+                    except (IntegrityError, DataError) as e:
+                        logger.error("Error creating group %s: %s" % (groupname, e))
+                        user_Membership_errors += 1
+                        continue
                     if created:
                         logger.debug("Created group %s" % groupname)
-                    #Now well assign the user
-                    group.user_set.add(user)
-                    user_Membership_added += 1
-        #Default Primary Group: Temporary is fixed
-
-
-        #removing group membership
-        for check_group in actualGroups:
-            if (check_group not in ldap_name_groups):
-                group = Group.objects.get(name=check_group)
-                group.user_set.remove(user)
-                user_Membership_deleted += 1
-
+                    group_pk = group_pks[groupname.lower()] = group.pk
+                added_pks.append(group_pk)
+
+        #removing group membership. The groups outside LDAP_SYNC_GROUP_ALLOW and LDAP_SYNC_GROUP_DENY aren't managed
+        removed_pks = [pk for name, pk in actualGroups.items() if ((name not in ldap_name_groups) and self.query.is_allowed_group(name))]
+
+        if (added_pks):
+            user.groups.add(*added_pks)
+            user_Membership_added = len(added_pks)
+        if (removed_pks):
+            user.groups.remove(*removed_pks)
+            user_Membership_deleted = len(removed_pks)
         if ((user_Membership_deleted > 0) or (user_Membership_added > 0)):
-            group.save()
             logger.info("Group membership for user %s synchronized: %d Added, %d Removed" % (user.username, user_Membership_added, user_Membership_deleted))
         #Return statistics
-        self.stats_membership_total += user_Membership_total
-        self.stats_membership_added += user_Membership_added
-        self.stats_membership_deleted += user_Membership_deleted
-        self.stats_membership_errors += user_Membership_errors
+        username = getattr(user, self.conf_LDAP_SYNC_USERNAME_FIELD).lower()
+        self.add_stat('stats_membership_total', username, user_Membership_total)
+        self.add_stat('stats_membership_added', username, user_Membership_added)
+        self.add_stat('stats_membership_deleted', username, user_Membership_deleted)
+        self.add_stat('stats_membership_errors', username, user_Membership_errors)
 
-    def ldap_search(self, filter, attributes, incremental, incremental_filter):
+    def ldap_search(self, filter, attributes, incremental, incremental_filter, entry_type=None, search_info=None, shards=0):
         """
         Query the configured LDAP server with the provided search filter and
-        attribute list.
+        attribute list. With an entry_type, the results are streamed page by page
+        as compact LDAPEntry objects instead of being returned as a list.
+        With shards, incremental searches also return the next shard of the full
+        search, instead of running a full one every LDAP_SYNC_INCREMENTAL_BETWEEN_FULL.
+        If given, search_info is filled with details of the search that was run.
         """
-        for uri in self.conf_LDAP_SYNC_BIND_URI:
+        for uri in self.get_bind_uris():
             #Read record of this uri
             if (self.working_uri == uri):
                 adldap_sync = self.working_adldap_sync
@@ -698,41 +1512,136 @@ class Command(BaseCommand):
             else:
                 adldap_sync, created = ADldap_Sync.objects.get_or_create(ldap_sync_uri=uri)
 
-            if ((adldap_sync.syncs_to_full > 0) and incremental):
+            shard = None
+            #The first sync is always a full one
+            if (shards and incremental and adldap_sync.total_syncs):
+                shard = adldap_sync.user_shard % shards
+                filter_to_use = '(|%s(&%s%s))' % (incremental_filter.replace('?', self.whenchanged.strftime(self.conf_LDAP_SYNC_INCREMENTAL_TIMESTAMPFORMAT)), filter, self.query.shard_filter(shard, shards))
+                logger.debug("Using an incremental search with the shard %d of %d. Filter is:'%s'" % (shard + 1, shards, filter_to_use))
+            elif ((adldap_sync.syncs_to_full > 0) and incremental and (not self.is_shards_start(adldap_sync))):
                 filter_to_use = incremental_filter.replace('?', self.whenchanged.strftime(self.conf_LDAP_SYNC_INCREMENTAL_TIMESTAMPFORMAT))
                 logger.debug("Using an incremental search. Filter is:'%s'" % filter_to_use)
             else:
                 filter_to_use = filter
+            if (search_info is not None):
+                search_info['incremental'] = (filter_to_use != filter)
+                search_info['shard'] = shard
 
-            ldap.set_option(ldap.OPT_REFERRALS, 0)
-            #ldap.set_option(ldap.OPT_NETWORK_TIMEOUT, 10)
-            l = PagedLDAPObject(uri)
-            l.protocol_version = 3
-
-            if (uri.startswith('ldaps:')):
-                l.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
-                l.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND)
-                l.set_option(ldap.OPT_X_TLS_DEMAND, True)
-            else:
-                l.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_NEVER)
-                l.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-                l.set_option(ldap.OPT_X_TLS_DEMAND, False)
             try:
-                l.simple_bind_s(self.conf_LDAP_SYNC_BIND_DN, self.conf_LDAP_SYNC_BIND_PASS)
+                l = self.get_ldap_connection(uri)
             except ldap.LDAPError as e:
                 logger.error("Error connecting to LDAP server %s : %s" % (uri, e))
+                if (self.server_health is not None):
+                    self.server_health.set(uri, False)
                 continue
+            l.page_tuner = self.get_page_tuner(uri, adldap_sync)
 
-            results = l.paged_search_ext_s(self.conf_LDAP_SYNC_BIND_SEARCH, ldap.SCOPE_SUBTREE, filter_to_use, attrlist=attributes, serverctrls=None)
-            l.unbind_s()
-            if (self.working_uri is None):
-                self.working_uri = uri
-                self.conf_LDAP_SYNC_BIND_URI.insert(0, uri)
-                self.working_adldap_sync = adldap_sync
+            if (entry_type is not None):
+                results = self.ldap_search_entries(uri, l, filter_to_use, entry_type)
+            else:
+                results = l.paged_search_ext_s(self.conf_LDAP_SYNC_BIND_SEARCH, ldap.SCOPE_SUBTREE, filter_to_use, attrlist=attributes, serverctrls=None)
+                self.release_ldap_connection(uri, l)
+            #Searches are captured by their configured filter, so the incremental ones can be replayed later. The user counts aren't needed
+            if ((self.capture is not None) and ((entry_type is None) or (list(attributes) != [self.ATTRIBUTE_NO_ATTRIBUTES]))):
+                results = self.capture.capture(filter, (filter_to_use != filter), results)
+            #Searches may run in parallel with the async engine
+            with self.working_uri_lock:
+                if (self.working_uri is None):
+                    self.working_uri = uri
+                    self.conf_LDAP_SYNC_BIND_URI.insert(0, uri)
+                    self.working_adldap_sync = adldap_sync
 
             return (uri, results)  # Return both the LDAP server URI used and the request. This is for incremental sync purposes
         #if not connected correctly, raise error
-        raise
+        raise ldap.SERVER_DOWN({'desc': "Can't connect to any LDAP server: %s" % ", ".join(self.conf_LDAP_SYNC_BIND_URI)})
+
+    def is_shards_start(self, adldap_sync):
+        """
+        If the users shards start over on this run. With LDAP_SYNC_USER_SHARDS the full
+        syncs don't run, so the other searches (i.e. the groups) are full ones then.
+        """
+        return (bool(self.conf_LDAP_SYNC_USER_SHARDS) and self.conf_LDAP_SYNC_USER and ((adldap_sync.user_shard % self.conf_LDAP_SYNC_USER_SHARDS) == 0))
+
+    def get_bind_uris(self):
+        """
+        The LDAP servers to try, in order. The first search ranks them by health
+        and round-trip time; then the server in use always comes first, so the
+        whole run (and its incremental watermark) stays on it.
+        """
+        with self.working_uri_lock:
+            if ((self.working_uri is None) and (self.server_health is None) and self.conf_LDAP_SYNC_BIND_HEALTH_CACHE and (len(self.conf_LDAP_SYNC_BIND_URI) > 1)):
+                self.server_health = ServerHealth(self.conf_LDAP_SYNC_BIND_HEALTH_CACHE, self.conf_LDAP_SYNC_BIND_HEALTH_TTL)
+                #A probe connects, then binds, each one within LDAP_SYNC_BIND_TIMEOUT
+                self.conf_LDAP_SYNC_BIND_URI = self.server_health.rank(self.conf_LDAP_SYNC_BIND_URI, self.probe_ldap_server, 2 * self.conf_LDAP_SYNC_BIND_TIMEOUT)
+            return list(self.conf_LDAP_SYNC_BIND_URI)
+
+    def probe_ldap_server(self, uri):
+        self.get_ldap_connection(uri, pooled=False).unbind_s()
+
+    def get_ldap_connection(self, uri, pooled=True):
+        """A bound connection to an LDAP server, from the connection_pool if there is one."""
+        if (pooled and (self.connection_pool is not None)):
+            l = self.connection_pool.acquire((uri, self.conf_LDAP_SYNC_BIND_DN))
+            if (l is not None):
+                l.page_size = self.conf_LDAP_SYNC_BIND_PAGESIZE
+                return l
+        ldap.set_option(ldap.OPT_REFERRALS, 0)
+        l = PagedLDAPObject(uri)
+        l.protocol_version = 3
+        l.page_size = self.conf_LDAP_SYNC_BIND_PAGESIZE
+        #Only the connection and the bind have a timeout, a dead or hung server must not hang the sync
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT, self.conf_LDAP_SYNC_BIND_TIMEOUT)
+
+        if (uri.startswith('ldaps:')):
+            l.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
+            l.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND)
+            l.set_option(ldap.OPT_X_TLS_DEMAND, True)
+        else:
+            l.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_NEVER)
+            l.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+            l.set_option(ldap.OPT_X_TLS_DEMAND, False)
+        l.timeout = self.conf_LDAP_SYNC_BIND_TIMEOUT
+        l.simple_bind_s(self.conf_LDAP_SYNC_BIND_DN, self.conf_LDAP_SYNC_BIND_PASS)
+        #Big pages may take longer than the bind, so the searches wait as long as needed
+        l.timeout = -1
+        return l
+
+    def release_ldap_connection(self, uri, l):
+        """Close a connection after a search, or keep it in the connection_pool."""
+        if (self.connection_pool is not None):
+            l.page_tuner = None
+            self.connection_pool.release((uri, self.conf_LDAP_SYNC_BIND_DN), l)
+        else:
+            l.unbind_s()
+
+    def get_page_tuner(self, uri, adldap_sync):
+        """The page size tuner of an LDAP server. It starts from the page size learned on the previous runs."""
+        if (not self.conf_LDAP_SYNC_BIND_PAGESIZE_ADAPTIVE):
+            return None
+        with self.working_uri_lock:
+            if (uri not in self.page_tuners):
+                page_size = adldap_sync.page_size or self.conf_LDAP_SYNC_BIND_PAGESIZE
+                self.page_tuners[uri] = PageSizeTuner(page_size, self.conf_LDAP_SYNC_BIND_MAXPAGESIZE, self.conf_LDAP_SYNC_BIND_PAGE_MAXBYTES)
+            return self.page_tuners[uri]
+
+    def ldap_search_entries(self, uri, l, filter, entry_type):
+        """Stream the results of a paged search as LDAPEntry objects. The connection is released at the end."""
+        try:
+            for page in l.paged_search_ext_iter(self.conf_LDAP_SYNC_BIND_SEARCH, ldap.SCOPE_SUBTREE, filter, attrlist=list(entry_type.attributes), serverctrls=None):
+                for dn, ldap_attributes in page:
+                    entry = entry_type.entry(dn, ldap_attributes)
+                    if (entry is not None):
+                        yield entry
+        except BaseException:
+            #An interrupted search may leave pages pending, so the connection is never pooled
+            l.unbind_s()
+            raise
+        self.release_ldap_connection(uri, l)
+
+
+@receiver(setting_changed)
+def settings_changed(**kwargs):
+    Command.clear_config_cache()
 
 
 class PagedResultsSearchObject:
@@ -740,7 +1649,8 @@ class PagedResultsSearchObject:
     Taken from the python-ldap paged_search_ext_s.py demo, showing how to use
     the paged results control: https://bitbucket.org/jaraco/python-ldap/
     """
-    conf_LDAP_SYNC_BIND_PAGESIZE = max(10, getattr(settings, 'LDAP_SYNC_BIND_PAGESIZE', 200))
+    page_size = 200  # Set from LDAP_SYNC_BIND_PAGESIZE by get_ldap_connection()
+    page_tuner = None  # A PageSizeTuner, to adapt the page size while searching
 
     def paged_search_ext_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
                            serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
@@ -748,29 +1658,45 @@ class PagedResultsSearchObject:
         Behaves exactly like LDAPObject.search_ext_s() but internally uses the
         simple paged results control to retrieve search results in chunks.
         """
-        req_ctrl = SimplePagedResultsControl(True, size=self.conf_LDAP_SYNC_BIND_PAGESIZE, cookie='')
+        results = []
+        for rdata in self.paged_search_ext_iter(base, scope, filterstr, attrlist, attrsonly, serverctrls, clientctrls, timeout, sizelimit):
+            results.extend(rdata)
+        return results
+
+    def paged_search_ext_iter(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                              serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        """
+        Like paged_search_ext_s(), but yields the results one page at a time. The
+        next page is only requested once the previous one is consumed.
+        """
+        page_size = self.page_size
+        if (self.page_tuner is not None):
+            page_size = self.page_tuner.page_size
+        req_ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
 
         # Send first search request
+        started = time.time()
         msgid = self.search_ext(base, ldap.SCOPE_SUBTREE, filterstr, attrlist=attrlist,
                                 serverctrls=(serverctrls or []) + [req_ctrl])
-        results = []
 
         while True:
             rtype, rdata, rmsgid, rctrls = self.result3(msgid)
-            results.extend(rdata)
+            if (self.page_tuner is not None):
+                page_bytes = sum(len(value) for dn, attributes in rdata if isinstance(attributes, dict) for values in attributes.values() for value in values)
+                self.page_tuner.record(len(rdata), page_bytes, time.time() - started)
+                req_ctrl.size = self.page_tuner.page_size
+            yield rdata
             # Extract the simple paged results response control
             pctrls = [c for c in rctrls if c.controlType == SimplePagedResultsControl.controlType]
 
-            if pctrls:
-                if pctrls[0].cookie:
-                    # Copy cookie from response control to request control
-                    req_ctrl.cookie = pctrls[0].cookie
-                    msgid = self.search_ext(base, ldap.SCOPE_SUBTREE, filterstr, attrlist=attrlist,
-                                            serverctrls=(serverctrls or []) + [req_ctrl])
-                else:
-                    break
-
-        return results
+            if pctrls and pctrls[0].cookie:
+                # Copy cookie from response control to request control
+                req_ctrl.cookie = pctrls[0].cookie
+                started = time.time()
+                msgid = self.search_ext(base, ldap.SCOPE_SUBTREE, filterstr, attrlist=attrlist,
+                                        serverctrls=(serverctrls or []) + [req_ctrl])
+            else:
+                break
 
 
 class PagedLDAPObject(LDAPObject, PagedResultsSearchObject):
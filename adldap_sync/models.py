@@ -10,6 +10,7 @@ logger = logging.getLogger(__name__)
 SYNC_TYPES = (
     ('Full', _('Full')),
     ('Incremental', _('Incremental')),
+    ('Shard', _('Shard')),
     )
 
 
@@ -19,6 +20,10 @@ class ADldap_Sync(models.Model):
     whenchanged = models.DateTimeField(verbose_name=_('Last Update (UTC)'), default=datetime(1990, 1, 1, 1, 1, 1, 657692, tzinfo=pytz.UTC))
     #Make always the first synchronization a full one
     syncs_to_full = models.IntegerField(verbose_name=_('Incremental Syncs until Full Sync'), default=0)
+    #Page size learned by the adaptive LDAP paging. 0 until the first sync
+    page_size = models.IntegerField(verbose_name=_('LDAP Page Size'), default=0)
+    #Next users shard of the rolling full sync, see LDAP_SYNC_USER_SHARDS
+    user_shard = models.IntegerField(verbose_name=_('Next Users Shard'), default=0)
 
     #Statistics
     total_syncs = models.IntegerField(verbose_name=_('Total Syncs'), default=0)
@@ -29,6 +34,8 @@ class ADldap_Sync(models.Model):
     last_sync_user_updated = models.IntegerField(verbose_name=_('Last Sync: Users Updated'), default=0)
     last_sync_user_deleted = models.IntegerField(verbose_name=_('Last Sync: Users Deleted'), default=0)
     last_sync_user_errors = models.IntegerField(verbose_name=_('Last Sync: User Errors'), default=0)
+    #Users returned by the last full search, to estimate the progress of the next one
+    last_full_sync_user_total = models.IntegerField(verbose_name=_('Last Full Sync: Users Found in LDAP'), default=0)
 
     last_sync_group_total = models.IntegerField(verbose_name=_('Last Sync: Groups Found in LDAP'), default=0)
     last_sync_group_added = models.IntegerField(verbose_name=_('Last Sync: Groups Added'), default=0)
@@ -39,6 +46,7 @@ class ADldap_Sync(models.Model):
     last_sync_membership_added = models.IntegerField(verbose_name=_('Last Sync: Memberships Added'), default=0)
     last_sync_membership_deleted = models.IntegerField(verbose_name=_('Last Sync: Memberships Deleted'), default=0)
     last_sync_membership_errors = models.IntegerField(verbose_name=_('Last Sync: Membership Errors'), default=0)
+    last_sync_lock_wait = models.FloatField(verbose_name=_('Last Sync: Seconds Waiting for a Running Sync'), default=0)
 
     def __str__(self):
         return _('"%(uri)s": Synced %(total)d times. Last Sync: %(date)s ') % {'uri': self.ldap_sync_uri, 'total': self.total_syncs, 'date': self.whenchanged}
@@ -49,6 +57,40 @@ class ADldap_Sync(models.Model):
         db_table = "adldap_sync"
 
 
+
+ERROR_PHASES = (
+    ('group', _('Group')),
+    ('user', _('User')),
+    ('profile', _('Profile')),
+    ('photo', _('Photo')),
+    ('membership', _('Group Membership')),
+    )
+
+
+class ADldap_SyncError(models.Model):
+    #Entries that failed to sync, retried by 'syncldap retry'
+    dn = models.CharField(verbose_name=_('Distinguished Name'), max_length=500)
+    phase = models.CharField(verbose_name=_('Phase'), max_length=20, choices=ERROR_PHASES)
+    name = models.CharField(verbose_name=_('Name'), max_length=250, blank=True)
+    error = models.TextField(verbose_name=_('Error'), blank=True)
+    attempts = models.IntegerField(verbose_name=_('Failed Attempts'), default=1)
+    first_failure = models.DateTimeField(verbose_name=_('First Failure (UTC)'))
+    last_failure = models.DateTimeField(verbose_name=_('Last Failure (UTC)'))
+
+    @property
+    def entry_type(self):
+        """'group' or 'user', the kind of LDAP entry to search again."""
+        return ('group' if (self.phase == 'group') else 'user')
+
+    def __str__(self):
+        return _('%(phase)s error on "%(dn)s": %(error)s') % {'phase': self.phase, 'dn': self.dn, 'error': self.error}
+
+    class Meta:
+        verbose_name = _("Active Directory/LDAP Sync Error")
+        verbose_name_plural = _("Active Directory/LDAP Sync Errors")
+        db_table = "adldap_sync_error"
+        unique_together = (('dn', 'phase'),)
+
 ## Class Sample for User Profile
 #class Employee(models.Model):
 #    user = models.OneToOneField(User,verbose_name=_('User'), on_delete=models.CASCADE)
@@ -0,0 +1,48 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PageSizeTuner(object):
+    """
+    Adaptive page size for the LDAP paged searches. After each full page, the
+    entries/sec rate is compared with the previous page's, and the page size keeps
+    growing (or shrinking) while the rate improves, reversing when it doesn't.
+    Pages bigger than max_bytes (i.e. with photos) always shrink.
+    """
+    MIN_PAGESIZE = 10
+    GROWTH = 1.5
+
+    def __init__(self, page_size, max_page_size, max_bytes):
+        self.max_page_size = max(self.MIN_PAGESIZE, max_page_size)
+        self.max_bytes = max_bytes
+        self.page_size = self.clamp(page_size)
+        self.direction = 1
+        self.last_rate = None
+        self.best_rate = None
+        self.best_page_size = self.page_size
+
+    def clamp(self, page_size):
+        return int(min(self.max_page_size, max(self.MIN_PAGESIZE, page_size)))
+
+    def record(self, entries, size_bytes, elapsed):
+        """Account a page and choose the size of the next one."""
+        if (entries < self.page_size):
+            #The last page of a search is partial, and says nothing about the page size
+            return
+        rate = entries / max(elapsed, 0.000001)
+        if ((size_bytes <= self.max_bytes) and ((self.best_rate is None) or (rate > self.best_rate))):
+            self.best_rate = rate
+            self.best_page_size = self.page_size
+
+        if (size_bytes > self.max_bytes):
+            self.direction = -1
+        elif ((self.last_rate is not None) and (rate < self.last_rate)):
+            self.direction = -self.direction
+        self.last_rate = rate
+
+        if (self.direction > 0):
+            self.page_size = self.clamp(self.page_size * self.GROWTH)
+        else:
+            self.page_size = self.clamp(self.page_size / self.GROWTH)
+        logger.debug("LDAP page: %d entries, %d bytes, %.0f entries/s. Next page size: %d" % (entries, size_bytes, rate, self.page_size))
@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.files.images import get_image_dimensions
+from django.db import transaction
+
+from adldap_sync.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoUploader(object):
+    """
+    Bounded thread pool writing the profile photos to their storage, so remote
+    storages don't stall the sync loop. Identical images are only stored once
+    per run, failed writes are retried, and the stored names are attached to
+    the profiles with one bulk update per field when finish() is called, along
+    with the width_field/height_field of an ImageField. If that update fails,
+    the stored photos are deleted.
+    """
+    RETRIES = 3
+    BACKOFF = 0.5  # Seconds before the first retry, doubled on each one
+    QUEUED_PER_WORKER = 2  # Photos waiting for each thread. Beyond that submit() blocks, so a slow storage doesn't fill the memory
+    QUERY_BATCH_SIZE = 500  # Names or users per query in finish(), without a batch_size
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.queued = threading.BoundedSemaphore(max_workers * (1 + self.QUEUED_PER_WORKER))
+        self.lock = threading.Lock()
+        self.stored = {}  # (model label, field name, digest) -> Future of the stored name
+        self.jobs = []  # (profile model, user pk, field, username, guid, dn, old name, Future)
+
+    def submit(self, profile, field_name, content, name, username, guid=None, dn=None):
+        """Queue a photo for a profile. name is the file name to store it with, before upload_to."""
+        field = profile._meta.get_field(field_name)
+        old_name = getattr(profile, field_name).name or ''
+        self.queued.acquire()
+        try:
+            future = self.executor.submit(self.write, profile, field, content, name, old_name)
+        except BaseException:
+            self.queued.release()
+            raise
+        future.add_done_callback(lambda future: self.queued.release())
+        #Only the written photos hold the profile and its content, the jobs keep what finish() needs
+        self.jobs.append((type(profile), profile.user_id, field, username, guid, dn, old_name, future))
+
+    def write(self, profile, field, content, name, old_name):
+        """Store a photo, unless it's the current one. Returns the stored name and the dimension fields, or None if unchanged."""
+        digest = hashlib.sha1(content).digest()
+        if (old_name):
+            current = self.read(field.storage, old_name)
+            if ((current is not None) and (hashlib.sha1(current).digest() == digest)):
+                return None
+
+        key = (field.model._meta.label, field.name, digest)
+        with self.lock:
+            upload = self.stored.get(key)
+            owner = (upload is None)
+            if (owner):
+                upload = self.stored[key] = Future()
+        if (owner):
+            try:
+                upload.set_result(self.retry(self.store, profile, field, content, name))
+            except Exception as e:
+                upload.set_exception(e)
+        return (upload.result(), self.get_dimensions(field, content))
+
+    @staticmethod
+    def get_dimensions(field, content):
+        """Values of the width_field/height_field of an ImageField, as ImageField.update_dimension_fields sets them."""
+        dimensions = {}
+        if (getattr(field, 'width_field', None) or getattr(field, 'height_field', None)):
+            width, height = get_image_dimensions(ContentFile(content))
+            if (field.width_field):
+                dimensions[field.width_field] = width
+            if (field.height_field):
+                dimensions[field.height_field] = height
+        return dimensions
+
+    @staticmethod
+    def read(storage, name):
+        """Content of the current photo. None if it can't be read, so it's replaced."""
+        try:
+            with storage.open(name) as photo:
+                return photo.read()
+        except Exception:
+            return None
+
+    @staticmethod
+    def store(profile, field, content, name):
+        return field.storage.save(field.generate_filename(profile, name), ContentFile(content), max_length=field.max_length)
+
+    def retry(self, func, *args):
+        for attempt in range(self.RETRIES):
+            try:
+                return func(*args)
+            except Exception as e:
+                if ((attempt + 1) == self.RETRIES):
+                    raise
+                logger.warning("Photo storage error, retrying: %s" % e)
+                time.sleep(self.BACKOFF * (2 ** attempt))
+
+    def finish(self, batch_size=None):
+        """
+        Wait for the queued photos and attach them to their profiles. The replaced
+        photos no profile uses anymore are deleted.
+        Returns the usernames whose photo changed, and the (username, guid, dn, error) that failed.
+        """
+        query_size = (batch_size or self.QUERY_BATCH_SIZE)
+        changed = defaultdict(dict)  # (model, field) -> {user pk: (stored name, dimension fields, username, guid, dn)}
+        replaced = defaultdict(set)  # (model, field) -> old names
+        unused = defaultdict(set)  # (model, field) -> stored names that may have been left without a profile
+        updated_usernames = set()
+        failed = []
+        for model, user_pk, field, username, guid, dn, old_name, future in self.jobs:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("Error storing photo %s for user %s: %s" % (field.name, username, e))
+                failed.append((username, guid, dn, e))
+                continue
+            if (result is None):
+                continue
+            stored_name, dimensions = result
+            changed[(model, field)][user_pk] = (stored_name, dimensions, username, guid, dn)
+            if (old_name and (old_name != stored_name)):
+                replaced[(model, field)].add(old_name)
+        self.jobs = []
+
+        #New profiles may have been bulk created without a pk, so it's read back
+        for (model, field), photos in changed.items():
+            pks = {}
+            for user_pks in chunked(photos.keys(), query_size):
+                pks.update(model.objects.filter(user__in=user_pks).values_list('user_id', 'pk'))
+            #The profiles that couldn't be created don't get their photo
+            unused[(model, field)].update(photos[user_pk][0] for user_pk in (set(photos) - set(pks)))
+            photos = dict((user_pk, photo) for user_pk, photo in photos.items() if user_pk in pks)
+            profiles = [model(pk=pks[user_pk], **dict(dimensions, **{field.name: name})) for user_pk, (name, dimensions, username, guid, dn) in photos.items()]
+            update_fields = set([field.name])
+            for name, dimensions, username, guid, dn in photos.values():
+                update_fields.update(dimensions)
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_update(profiles, list(update_fields), batch_size=batch_size)
+            except Exception as e:
+                for name, dimensions, username, guid, dn in photos.values():
+                    logger.error("Error saving photo %s for user %s: %s" % (field.name, username, e))
+                    failed.append((username, guid, dn, e))
+                unused[(model, field)].update(name for name, dimensions, username, guid, dn in photos.values())
+                #The old photos are still in use
+                replaced.pop((model, field), None)
+                continue
+            updated_usernames.update(username for name, dimensions, username, guid, dn in photos.values())
+
+        deletions = []
+        for key in set(replaced) | set(unused):
+            model, field = key
+            old_names = replaced.get(key, set()) | unused.get(key, set())
+            #Identical photos are shared, so only the ones left without a profile are deleted
+            in_use = set()
+            for names in chunked(old_names, query_size):
+                in_use.update(model.objects.filter(**{field.name + '__in': names}).values_list(field.name, flat=True))
+            for old_name in (old_names - in_use):
+                deletions.append((old_name, self.executor.submit(self.retry, field.storage.delete, old_name)))
+        for old_name, future in deletions:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("Error deleting the photo %s: %s" % (old_name, e))
+        if (changed):
+            logger.debug("Stored the photos of %d users" % len(updated_usernames))
+        return (updated_usernames, failed)
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPConnectionPool(object):
+    """
+    Bound LDAP connections kept open between targeted syncs, so refreshing a
+    single user doesn't pay the TCP/TLS handshake and the bind again. Idle
+    connections are closed after max_idle seconds, before the server drops them.
+    """
+
+    def __init__(self, max_connections=4, max_idle=300):
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.connections = {}  # key -> [(connection, last use), ...]
+
+    def acquire(self, key):
+        """A pooled connection for key, or None if there is none left."""
+        expired = []
+        connection = None
+        with self.lock:
+            idle = self.connections.get(key, [])
+            while idle:
+                pooled, last_use = idle.pop()
+                if ((time.time() - last_use) < self.max_idle):
+                    connection = pooled
+                    break
+                expired.append(pooled)
+        for pooled in expired:
+            self.close(pooled)
+        return connection
+
+    def release(self, key, connection):
+        """Give back a connection after a successful search."""
+        with self.lock:
+            idle = self.connections.setdefault(key, [])
+            if (len(idle) < self.max_connections):
+                idle.append((connection, time.time()))
+                return
+        self.close(connection)
+
+    def clear(self):
+        with self.lock:
+            connections = [connection for idle in self.connections.values() for connection, last_use in idle]
+            self.connections = {}
+        for connection in connections:
+            self.close(connection)
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.unbind_s()
+        except Exception as e:
+            logger.debug("Error closing a pooled LDAP connection: %s" % e)
@@ -0,0 +1,93 @@
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'adldap_sync.progress'
+
+
+def get_progress(cache_alias='default'):
+    """
+    Progress of the running sync, from any process (i.e. while the Celery task
+    runs). Returns None if no sync is running.
+    """
+    return caches[cache_alias].get(CACHE_KEY)
+
+
+class SyncProgress(object):
+    """
+    Progress of a sync phase (groups, users) over a stream of entries. The rate
+    is computed over the last WINDOW seconds, and the ETA from an estimate of
+    the total (None if unknown). Only a few samples are kept, never the entries.
+    The state is published to a Django cache, see get_progress().
+    """
+    WINDOW = 30  # Seconds
+    TIMEOUT = 3600  # Seconds the published state survives a dead sync
+
+    def __init__(self, phase, total=None, cache_alias=''):
+        self.phase = phase
+        self.total = total
+        self.cache_alias = cache_alias
+        self.started = time.time()
+        self.processed = 0
+        self.samples = deque([(self.started, 0)])
+        self.publish()
+
+    @property
+    def rate(self):
+        """Entries per second over the rolling window."""
+        (first_time, first_processed), (last_time, last_processed) = self.samples[0], self.samples[-1]
+        if (last_time <= first_time):
+            return None
+        return (last_processed - first_processed) / (last_time - first_time)
+
+    @property
+    def eta(self):
+        """Seconds left, or None if unknown."""
+        rate = self.rate
+        if ((self.total is None) or (not rate)):
+            return None
+        return max(0, self.total - self.processed) / rate
+
+    def update(self, processed):
+        now = time.time()
+        self.processed = processed
+        self.samples.append((now, processed))
+        while ((len(self.samples) > 2) and ((now - self.samples[1][0]) >= self.WINDOW)):
+            self.samples.popleft()
+        self.publish()
+
+    def get_state(self, finished=False):
+        return {
+            'phase': self.phase,
+            'processed': self.processed,
+            'total': self.total,
+            'rate': self.rate,
+            'eta': self.eta,
+            'started': self.started,
+            'finished': finished,
+        }
+
+    def publish(self, finished=False):
+        if (self.cache_alias):
+            caches[self.cache_alias].set(CACHE_KEY, self.get_state(finished), self.TIMEOUT)
+
+    def finish(self, processed):
+        self.update(processed)
+        self.publish(finished=True)
+        logger.debug("%s: %d processed in %.1fs" % (self.phase, processed, time.time() - self.started))
+
+    def __str__(self):
+        message = "Processed %d" % self.processed
+        if (self.total is not None):
+            message += " of ~%d" % self.total
+        message += " %s" % self.phase
+        if (self.rate is not None):
+            message += ", %.0f/s" % self.rate
+        if (self.eta is not None):
+            message += ", ETA %s" % timedelta(seconds=int(self.eta))
+        return message
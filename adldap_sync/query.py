@@ -0,0 +1,165 @@
+import logging
+import re
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import FieldDoesNotExist
+from ldap.filter import escape_filter_chars
+
+from adldap_sync.entries import LDAPEntryType
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPQueryBuilder(object):
+    """
+    Attribute lists and filters for each phase of a sync, compiled once from the
+    command config. Only the attributes that end up in an existing model field
+    (or that the sync itself needs) are requested from the server.
+    """
+
+    SHARD_CHARACTERS = '0123456789abcdefghijklmnopqrstuvwxyz'  # Usernames are sharded by their first character
+
+    def __init__(self, command):
+        self.command = command
+        self.user_attributes = self.get_user_attributes()
+        self.username_attribute = next((name for name, field in command.conf_LDAP_SYNC_USER_ATTRIBUTES.items() if field == command.conf_LDAP_SYNC_USERNAME_FIELD), None)
+        self.user_entry_type = LDAPEntryType(self.user_attributes, command.PHOTO_ATTRIBUTES)
+        self.group_attributes = self.get_group_attributes()
+        #Membership only needs the group name
+        self.membership_attributes = [name for name, field in command.conf_LDAP_SYNC_GROUP_ATTRIBUTES.items() if field == 'name']
+        self.group_allow = [self.compile_pattern(pattern) for pattern in command.conf_LDAP_SYNC_GROUP_ALLOW]
+        self.group_deny = [self.compile_pattern(pattern) for pattern in command.conf_LDAP_SYNC_GROUP_DENY]
+        self.group_patterns_filter = self.get_group_patterns_filter()
+
+    @staticmethod
+    def escape(value):
+        """Escape a value for an LDAP filter (RFC 4515)."""
+        return escape_filter_chars(value)
+
+    @staticmethod
+    def has_field(model, name):
+        try:
+            model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def get_user_attributes(self):
+        command = self.command
+        model = get_user_model()
+        attributes = []
+        for name, field in command.conf_LDAP_SYNC_USER_ATTRIBUTES.items():
+            if self.has_field(model, field):
+                attributes.append(name)
+            else:
+                logger.warning("LDAP_SYNC_USER_ATTRIBUTES: '%s' is not a field of %s, %s won't be requested" % (field, model._meta.label, name))
+
+        #The callbacks receive every extra attribute. Otherwise only the ones stored on a profile are needed
+        if (command.conf_LDAP_SYNC_USER_CALLBACKS):
+            extra_attributes = list(command.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES)
+        else:
+            profile_fields = set()
+            for profile in command.conf_LDAP_SYNC_USER_EXTRA_PROFILES:
+                profile_fields.update(field.name for field in apps.get_model(profile)._meta.concrete_fields)
+            extra_attributes = [name for name in command.conf_LDAP_SYNC_USER_EXTRA_ATTRIBUTES if command.get_profile_field_name(name) in profile_fields]
+        extra_attributes += command.get_required_user_attributes()
+
+        for name in extra_attributes:
+            if (name.lower() not in [attribute.lower() for attribute in attributes]):
+                attributes.append(name)
+        return attributes
+
+    @staticmethod
+    def compile_pattern(pattern):
+        """Case insensitive regex of a group name pattern, where * matches anything."""
+        return re.compile('^%s$' % '.*'.join(re.escape(part) for part in pattern.split('*')), re.IGNORECASE)
+
+    def get_group_patterns_filter(self):
+        """
+        LDAP_SYNC_GROUP_ALLOW and LDAP_SYNC_GROUP_DENY as a filter on the group name,
+        i.e. (&(|(cn=App-*)(cn=Staff))(!(|(cn=App-Test*)))). Empty if there are no patterns.
+        """
+        if ((not self.membership_attributes) or (not (self.command.conf_LDAP_SYNC_GROUP_ALLOW or self.command.conf_LDAP_SYNC_GROUP_DENY))):
+            return ''
+        name_attribute = self.membership_attributes[0]
+
+        def names(patterns):
+            #'?' is escaped too, as it's replaced by the timestamp in the incremental filters
+            return '(|%s)' % ''.join('(%s=%s)' % (name_attribute, '*'.join(self.escape(part).replace('?', '\\3f') for part in pattern.split('*')))
+                                     for pattern in patterns)
+        patterns_filter = ''
+        if (self.command.conf_LDAP_SYNC_GROUP_ALLOW):
+            patterns_filter += names(self.command.conf_LDAP_SYNC_GROUP_ALLOW)
+        if (self.command.conf_LDAP_SYNC_GROUP_DENY):
+            patterns_filter += '(!%s)' % names(self.command.conf_LDAP_SYNC_GROUP_DENY)
+        return '(&%s)' % patterns_filter
+
+    def is_allowed_group(self, name):
+        """If a group is synced, according to LDAP_SYNC_GROUP_ALLOW and LDAP_SYNC_GROUP_DENY."""
+        if (self.group_allow and (not any(pattern.match(name) for pattern in self.group_allow))):
+            return False
+        return (not any(pattern.match(name) for pattern in self.group_deny))
+
+    def group_filter(self, group_filter):
+        """A group search filter, restricted to the allowed group names."""
+        if (not self.group_patterns_filter):
+            return group_filter
+        return '(&%s%s)' % (group_filter, self.group_patterns_filter)
+
+    def get_group_attributes(self):
+        command = self.command
+        attributes = [name for name, field in command.conf_LDAP_SYNC_GROUP_ATTRIBUTES.items() if self.has_field(Group, field)]
+        #The group graph is built from the groups' own memberOf. With the snapshot, it tells if the nesting changed
+        if (command.conf_LDAP_SYNC_GROUP_MEMBERSHIP and (command.conf_LDAP_SYNC_GROUP_MEMBERSHIP_LOCAL_GRAPH or command.conf_LDAP_SYNC_USER_SNAPSHOT_FILE)):
+            attributes.append(command.ATTRIBUTE_MEMBEROF)
+        return attributes
+
+    def dns_filter(self, dns):
+        """Filter matching some entries by DN: (|(distinguishedName=...)(distinguishedName=...))"""
+        return '(|%s)' % ''.join('(distinguishedName=%s)' % self.escape(dn) for dn in dns)
+
+    def children_filter(self, dns):
+        """LDAP_SYNC_GROUP_FILTER restricted to the groups nested in some groups: (&(objectClass=group)(|(memberOf=...)(memberOf=...)))"""
+        return '(&%s(|%s))' % (self.command.conf_LDAP_SYNC_GROUP_FILTER, ''.join('(%s=%s)' % (self.command.ATTRIBUTE_MEMBEROF, self.escape(dn)) for dn in dns))
+
+    def usernames_filter(self, usernames):
+        """LDAP_SYNC_USER_FILTER restricted to some usernames."""
+        names = ''.join('(%s=%s)' % (self.username_attribute, self.escape(username)) for username in usernames)
+        return '(&%s(|%s))' % (self.command.conf_LDAP_SYNC_USER_FILTER, names)
+
+    def shard_bounds(self, shard, shards):
+        """
+        (lowest, highest) first character of the usernames in a shard, as a range
+        [lowest, highest). The first and last shards are open, so every username
+        falls in exactly one of them.
+        """
+        characters = self.SHARD_CHARACTERS
+        lowest = (characters[(shard * len(characters)) // shards] if shard else None)
+        highest = (characters[((shard + 1) * len(characters)) // shards] if (shard + 1) < shards else None)
+        return (lowest, highest)
+
+    def shard_filter(self, shard, shards):
+        """Name-range filter of a shard, i.e. (&(sAMAccountName>=g)(!(sAMAccountName>=n)))"""
+        lowest, highest = self.shard_bounds(shard, shards)
+        shard_filter = ''
+        if (lowest is not None):
+            shard_filter += '(%s>=%s)' % (self.username_attribute, lowest)
+        if (highest is not None):
+            shard_filter += '(!(%s>=%s))' % (self.username_attribute, highest)
+        return '(&%s)' % shard_filter
+
+    def in_shard(self, username, shard, shards):
+        """
+        If a lowercased username is in a shard. Only the usernames starting with one of
+        SHARD_CHARACTERS are known for sure, as LDAP servers may order the others differently.
+        """
+        first = username[:1]
+        if ((not first) or (first not in self.SHARD_CHARACTERS)):
+            return False
+        lowest, highest = self.shard_bounds(shard, shards)
+        return (((lowest is None) or (first >= lowest)) and ((highest is None) or (first < highest)))
+
+    def membership_filter(self, user_dn):
+        return self.group_filter(self.command.conf_LDAP_SYNC_GROUP_MEMBERSHIP_FILTER.replace('{distinguishedName}', self.escape(user_dn)))
@@ -0,0 +1,91 @@
+import logging
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from adldap_sync.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+class DNResolver(object):
+    """
+    Links DN-valued attributes (i.e. manager) to Django users, on the profile
+    fields of LDAP_SYNC_USER_DN_RESOLVE. The DNs are collected while syncing and
+    resolved in bulk by resolve(): first from the users seen in the run, then
+    with a single LDAP search per chunk of unknown DNs. The profiles are then
+    updated with one bulk_update per field, only where the user changed.
+    """
+
+    def __init__(self, command, profile_models):
+        self.command = command
+        self.fields = {}  # profile model -> [(LDAP attribute, field), ...]
+        for profile_model in profile_models:
+            fields = [(attribute, field) for attribute, field in command.conf_LDAP_SYNC_USER_DN_RESOLVE.items() if command.query.has_field(profile_model, field)]
+            if (fields):
+                self.fields[profile_model] = fields
+        self.usernames = {}  # lowercased DN -> username, of the users seen in the run
+        self.pending = defaultdict(dict)  # (profile model, field) -> {user pk: lowercased DN or None}
+
+    def add_user(self, dn, username):
+        if (dn is not None):
+            self.usernames[dn.lower()] = username
+
+    def add_profiles(self, user_pk, attributes):
+        for profile_model, fields in self.fields.items():
+            for attribute, field in fields:
+                dn = attributes.value(attribute)
+                self.pending[(profile_model, field)][user_pk] = (dn.lower() if dn else None)
+
+    def resolve(self):
+        if (not self.pending):
+            return
+        dns = set(dn for user_dns in self.pending.values() for dn in user_dns.values() if dn is not None)
+        usernames = self.get_usernames(dns)
+        model = get_user_model()
+        username_field = self.command.conf_LDAP_SYNC_USERNAME_FIELD
+        lower_username = 'lower_' + username_field
+        user_pks = {}
+        for chunk in chunked(set(usernames.values()), self.command.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            user_pks.update(model.objects.annotate(**{lower_username: Lower(username_field)})
+                            .filter(**{lower_username + '__in': chunk}).values_list(lower_username, 'pk'))
+        #DNs of users that aren't synced link to nobody
+        targets = dict((dn, user_pks.get(username)) for dn, username in usernames.items())
+        targets[None] = None
+
+        for (profile_model, field), user_dns in self.pending.items():
+            attname = profile_model._meta.get_field(field).attname
+            changed = []
+            for chunk in chunked(user_dns.keys(), self.command.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                for pk, user_pk, current in profile_model.objects.filter(user__in=chunk).values_list('pk', 'user_id', attname):
+                    dn = user_dns[user_pk]
+                    if ((dn in targets) and (targets[dn] != current)):
+                        changed.append(profile_model(pk=pk, **{attname: targets[dn]}))
+            if (changed):
+                with transaction.atomic():
+                    profile_model.objects.bulk_update(changed, [field], batch_size=self.command.conf_LDAP_SYNC_BULK_BATCH_SIZE)
+            logger.debug("Resolved %s.%s: %d profiles updated" % (profile_model._meta.label, field, len(changed)))
+        self.pending = defaultdict(dict)
+
+    def get_usernames(self, dns):
+        """Lowercased username of each DN. DNs that couldn't be searched are left out, so their profiles are untouched."""
+        usernames = dict((dn, self.usernames.get(dn)) for dn in dns)
+        unknown = [dn for dn, username in usernames.items() if username is None]
+        query = self.command.query
+        for chunk in chunked(unknown, self.command.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+            dn_filter = query.dns_filter(chunk)
+            try:
+                uri, results = self.command.ldap_search(dn_filter, [query.username_attribute], False, dn_filter)
+            except Exception as e:
+                logger.error("Error resolving %d DNs: %s" % (len(chunk), e))
+                for dn in chunk:
+                    usernames.pop(dn)
+                continue
+            for dn, attributes in results:
+                if (isinstance(attributes, dict) and (dn is not None)):
+                    values = [values for name, values in attributes.items() if name.lower() == query.username_attribute.lower()]
+                    if (values):
+                        usernames[dn.lower()] = values[0][0].decode('utf-8').lower()
+        return usernames
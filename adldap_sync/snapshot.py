@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import sqlite3
+import struct
+
+logger = logging.getLogger(__name__)
+
+
+class LDAPSnapshot(object):
+    """
+    SQLite side file holding the last LDAP state applied to Django.
+    Each entry is keyed by its objectGUID and keeps a digest of its attributes,
+    so entries that didn't change since the last run can be skipped. The digest
+    also covers the group nesting, as nested membership changes don't change the
+    user entries. It's only known when all the groups were searched; otherwise
+    the last known one is used.
+    """
+
+    def __init__(self, path, fingerprint='', nesting=None):
+        self.path = path
+        self.pending = {}
+        self.discarded = set()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot (guid BLOB PRIMARY KEY, digest BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if (nesting is None):
+            row = self.connection.execute("SELECT value FROM state WHERE name = 'nesting'").fetchone()
+            nesting = (row[0] if row else '')
+        else:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('nesting', ?)", (nesting,))
+        #Both are hashed in every digest, so a config or nesting change invalidates the whole snapshot
+        self.fingerprint = (fingerprint + nesting).encode('utf-8')
+        self.digests = dict(self.connection.execute('SELECT guid, digest FROM snapshot'))
+        logger.debug("Loaded %d entries from LDAP snapshot %s" % (len(self.digests), path))
+
+    def digest(self, attributes):
+        """Digest of an LDAP entry, independent of the attribute order."""
+        entry_hash = hashlib.sha1(self.fingerprint)
+        for name in sorted(attributes, key=lambda n: n.lower()):
+            lower_name = name.lower().encode('utf-8')
+            entry_hash.update(struct.pack('>I', len(lower_name)) + lower_name)
+            for value in attributes[name]:
+                entry_hash.update(struct.pack('>I', len(value)) + value)
+        return entry_hash.digest()
+
+    def is_unchanged(self, guid, digest):
+        return (self.digests.get(guid) == digest)
+
+    def update(self, guid, digest):
+        """Mark an entry as applied. It's written on commit()."""
+        self.pending[guid] = digest
+        self.discarded.discard(guid)
+
+    def discard(self, guid):
+        """Forget an entry, so it's fully applied on the next run."""
+        self.pending.pop(guid, None)
+        self.discarded.add(guid)
+
+    def commit(self):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO snapshot (guid, digest) VALUES (?, ?)', self.pending.items())
+            self.connection.executemany('DELETE FROM snapshot WHERE guid = ?', [(guid,) for guid in self.discarded])
+        logger.debug("LDAP snapshot %s: %d entries written, %d discarded" % (self.path, len(self.pending), len(self.discarded)))
+        self.digests.update(self.pending)
+        for guid in self.discarded:
+            self.digests.pop(guid, None)
+        self.pending = {}
+        self.discarded = set()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,184 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from adldap_sync.entries import LDAPEntryType
+from adldap_sync.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+class MultiSourceSync(object):
+    """
+    Sync of several LDAP sources (LDAP_SYNC_SOURCES), i.e. the domains of a
+    forest. Each source is a syncldap command with its own connection and search
+    settings, and its own incremental watermarks (the sync records are keyed by
+    URI). All of them are searched concurrently, and their entries are applied
+    by the main command through a single pipeline. When a username exists in
+    several sources, the first source in LDAP_SYNC_SOURCES wins: the usernames of
+    the sources are searched first, so collisions are settled before any entry
+    is applied. The statistics of each entry are counted on its source too.
+    """
+    QUEUE_SIZE = 2  # Chunks of users fetched ahead per source
+
+    def __init__(self, command, sync_type=''):
+        self.command = command
+        self.sources = []
+        for definition in command.conf_LDAP_SYNC_SOURCES:
+            source = command.__class__()
+            source.source = definition
+            source.load_config(syncType=sync_type)
+            source.uri_groups_server = None
+            source.uri_users_server = None
+            self.sources.append(source)
+        self.failed = set()  # Sources that couldn't be searched
+        self.skipped = set()  # Sources whose users aren't applied
+        self.owners = {}  # username -> priority of the first source that has it
+        self.collisions = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        command = self.command
+        executor = ThreadPoolExecutor(max_workers=3 * len(self.sources))
+        users_queue = queue.Queue(maxsize=self.QUEUE_SIZE * len(self.sources))
+        try:
+            group_futures = [executor.submit(self.fetch_groups, source) for source in self.sources]
+            #No source comes after the last one, so its usernames aren't needed
+            username_futures = [executor.submit(self.fetch_usernames, source) for source in self.sources[:-1]]
+            for priority, source in enumerate(self.sources):
+                executor.submit(self.fetch_users, priority, source, users_queue)
+
+            ldap_groups = self.merge_groups([future.result() for future in group_futures])
+            #The nesting of the snapshot is only known if every source searched all its groups
+            nestings = [source.get_group_nesting() for source in self.sources]
+            command.group_nesting = (repr(nestings) if (None not in nestings) else None)
+            if ldap_groups:
+                command.sync_ldap_groups(ldap_groups)
+            self.load_owners([future.result() for future in username_futures])
+            #Memberships are searched on the source of each user
+            command.entry_sources = dict((source.query.user_entry_type, source) for source in self.sources)
+            command.sync_ldap_users(self.iter_users(users_queue))
+        finally:
+            #Unblock the source threads if the pipeline failed
+            self.stopped.set()
+            executor.shutdown()
+            command.entry_sources = {}
+            command.stats_sources = {}
+
+        for priority, source in enumerate(self.sources):
+            if (priority in self.failed):
+                logger.error("LDAP source %s failed, its watermark is not updated" % source.source['NAME'])
+                continue
+            source.save_ldap_sync(source.uri_groups_server, source.uri_users_server)
+        logger.info("Multi-source synchronization finished: %d sources, %d usernames found in more than one source. Users (%d): A:%d U:%d D:%d Err:%d" %
+                    (len(self.sources), self.collisions, command.stats_user_total, command.stats_user_added, command.stats_user_updated,
+                     command.stats_user_deleted, command.stats_user_errors))
+
+    def fetch_groups(self, source):
+        try:
+            source.uri_groups_server, ldap_groups = source.get_ldap_groups()
+            return ldap_groups
+        except Exception as e:
+            logger.error("Error retrieving groups from LDAP source %s: %s" % (source.source['NAME'], e))
+            self.failed.add(self.sources.index(source))
+            return None
+        finally:
+            connection.close()
+
+    def fetch_usernames(self, source):
+        """All the usernames of a source, even on incremental runs: its unchanged users still win over the next sources."""
+        try:
+            username_type = LDAPEntryType([source.query.username_attribute])
+            uri, entries = source.ldap_search(source.conf_LDAP_SYNC_USER_FILTER, username_type.attributes, False, source.conf_LDAP_SYNC_USER_FILTER, username_type)
+            return set(entry.value(source.query.username_attribute, '').lower() for entry in entries)
+        except Exception as e:
+            logger.error("Error retrieving the usernames of LDAP source %s: %s" % (source.source['NAME'], e))
+            return None
+        finally:
+            connection.close()
+
+    def load_owners(self, source_usernames):
+        for priority, usernames in enumerate(source_usernames):
+            if (usernames is None):
+                #The next sources could override the users of this one, so none of them is applied
+                skipped = range(priority, len(self.sources))
+                logger.error("LDAP sources %s skipped, as the usernames of %s are unknown" % (", ".join(self.sources[skipped_priority].source['NAME'] for skipped_priority in skipped),
+                                                                                            self.sources[priority].source['NAME']))
+                self.failed.update(skipped)
+                self.skipped.update(skipped)
+                return
+            for username in usernames:
+                self.owners.setdefault(username, priority)
+
+    def fetch_users(self, priority, source, users_queue):
+        """Search the users of a source, and queue them one chunk at a time. None marks the end."""
+        try:
+            source.uri_users_server, ldap_users = source.get_ldap_users()
+            for chunk in chunked(ldap_users or [], self.command.conf_LDAP_SYNC_BULK_BATCH_SIZE):
+                if (self.stopped.is_set()):
+                    return
+                self.put(users_queue, (priority, chunk))
+            self.put(users_queue, (priority, None))
+        except Exception as e:
+            self.put(users_queue, (priority, e))
+        finally:
+            connection.close()
+
+    def put(self, users_queue, item):
+        while (not self.stopped.is_set()):
+            try:
+                users_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def merge_groups(self, source_groups):
+        """Groups of all the sources. On a name collision, the group of the first source is kept."""
+        names = set()
+        merged = []
+        for priority, ldap_groups in enumerate(source_groups):
+            if (not ldap_groups):
+                continue
+            name_attribute = self.sources[priority].query.membership_attributes[0].lower()
+            for dn, attributes in ldap_groups:
+                if (not isinstance(attributes, dict)):
+                    continue
+                name = [values[0].lower() for key, values in attributes.items() if key.lower() == name_attribute]
+                if (name and (name[0] in names)):
+                    continue
+                names.update(name)
+                merged.append((dn, attributes))
+                self.sources[priority].stats_group_total += 1
+                self.command.stats_sources[dn] = self.sources[priority]
+        return merged
+
+    def iter_users(self, users_queue):
+        """Users of all the sources, as they arrive. A user found on several sources is only applied from the first one."""
+        command = self.command
+        running = set(range(len(self.sources)))
+        while running:
+            priority, chunk = users_queue.get()
+            source = self.sources[priority]
+            if (isinstance(chunk, Exception)):
+                logger.error("Error retrieving users from LDAP source %s: %s" % (source.source['NAME'], chunk))
+                self.failed.add(priority)
+                running.discard(priority)
+                continue
+            if (chunk is None):
+                running.discard(priority)
+                continue
+            if (priority in self.skipped):
+                continue
+            for entry in chunk:
+                username = entry.value(source.query.username_attribute, '').lower()
+                if (self.owners.get(username, priority) < priority):
+                    self.collisions += 1
+                    continue
+                command.stats_sources[username] = source
+                source.stats_user_total += 1
+                yield entry
+        #Removed users can only be detected when every source returned all of its users
+        command.users_full_search = ((not self.failed) and all(source.users_full_search for source in self.sources))
@@ -0,0 +1,41 @@
+import logging
+
+import ldap
+
+from adldap_sync.management.commands.syncldap import Command
+from adldap_sync.pool import LDAPConnectionPool
+
+logger = logging.getLogger(__name__)
+
+#Warm connections shared by all the targeted syncs of this process
+connection_pool = LDAPConnectionPool()
+
+
+def sync_ldap(sync_type='', engine='sync', reload_config=False):
+    """
+    Run a whole synchronization, like the syncldap command, without going through
+    call_command. The config is only validated on the first run of the process,
+    or again with reload_config (i.e. after the settings of a worker changed).
+    """
+    Command().handle(syncType=sync_type, engine=engine, reload_config=reload_config)
+
+
+def sync_users(usernames):
+    """
+    Synchronize some users right away (attributes, profiles and group membership),
+    i.e. on login or from a webhook. All of them are retrieved with one LDAP search,
+    on a pooled connection. The incremental sync timestamps aren't touched.
+    Returns the usernames found in LDAP.
+    """
+    for attempt in range(2):
+        command = Command()
+        command.load_config(syncType='')
+        command.connection_pool = connection_pool
+        try:
+            return command.sync_ldap_usernames(usernames)
+        except ldap.SERVER_DOWN as e:
+            #The server dropped the pooled connections. Users are only written once all of them are retrieved, so it's safe to retry
+            logger.warning("LDAP connection lost, retrying with a new one: %s" % e)
+            connection_pool.clear()
+            if (attempt > 0):
+                raise
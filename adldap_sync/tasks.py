@@ -1,11 +1,22 @@
 from celery import shared_task
-from django.core.management import call_command
+
+from adldap_sync.sync import sync_ldap, sync_users
+
+
+@shared_task
+def syncldap(reload_config=False):
+    """
+    Synchronize the LDAP users with the local database, like the syncldap
+    management command. The settings are cached by the worker, reload_config
+    validates them again.
+    """
+    sync_ldap(reload_config=reload_config)
 
 
 @shared_task
-def syncldap():
+def syncldap_users(usernames):
     """
-    Call the appropriate management command to synchronize the LDAP users
-    with the local database.
+    Synchronize only the given LDAP users with the local database.
+    Returns the usernames found in LDAP.
     """
-    call_command('syncldap')
+    return sorted(sync_users(usernames))
@@ -0,0 +1,32 @@
+from functools import lru_cache
+
+
+def chunked(items, size):
+    """Split an iterable in lists of at most size items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if (len(chunk) >= size):
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DecodeCache(object):
+    """
+    LRU cache of decoded attribute values. Values like the manager DN or the
+    department repeat across many users, so each distinct one is decoded (and
+    joined with the separator) once, and the same str is shared by every user.
+    """
+
+    def __init__(self, maxsize, separator):
+        self.separator = separator
+        self.decode = (lru_cache(maxsize=maxsize)(self._decode) if maxsize else self._decode)
+
+    def _decode(self, values):
+        """values is a tuple of bytes, so it can be a cache key."""
+        return self.separator.join(value.decode('utf-8') for value in values)
+
+    def __call__(self, values):
+        return self.decode(tuple(values))